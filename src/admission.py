@@ -0,0 +1,127 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from ftp.shaping import TokenBucket
+
+# seconds an expensive request is assumed to take before one was measured
+DEFAULT_SERVICE_TIME = 1.0
+
+# weight of a new measurement in the average service time
+SMOOTHING = 0.3
+
+
+class Admission:
+    """
+    Decides when expensive requests run.
+
+    Each client may start `client_rate` expensive requests per second on
+    average, in bursts of up to `client_burst`. At most `budget` of them run
+    at once across all clients, and up to `max_queued` more wait in a priority
+    queue: cheaper methods first, then requests of clients with fewer
+    requests in flight, then in arrival order. Anything beyond that is
+    rejected with the seconds after which a retry should be admitted.
+
+    Cheap requests never pass through here, so they don't queue behind
+    searches.
+    """
+
+    def __init__(self, budget=4, max_queued=32, client_rate=5.0, client_burst=10):
+        self.budget = budget
+        self.active = 0
+
+        self.max_queued = max_queued
+        self.queue: List[Tuple[int, int, int, asyncio.Future]] = []
+        self.arrivals = itertools.count()
+
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.buckets: Dict[str, TokenBucket] = {}
+
+        # expensive requests admitted or queued, by client
+        self.in_flight: Dict[str, int] = {}
+
+        # moving average of the seconds an expensive request runs
+        self.service_time = DEFAULT_SERVICE_TIME
+
+    def reject(self, client: str) -> Optional[float]:
+        """
+        Returns the seconds `client` should wait before retrying if its
+        request can't be admitted now, or `None` if it can. An admitted
+        request counts against the client's rate.
+        """
+        if self.active >= self.budget and len(self.queue) >= self.max_queued:
+            # roughly when the request at the back of the queue will start
+            return self.service_time * (len(self.queue) + 1) / self.budget
+
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(
+                self.client_rate, self.client_burst
+            )
+
+        wait = bucket.take(1)
+        if wait > 0:
+            return wait
+
+        return None
+
+    def forget(self, client: str):
+        self.buckets.pop(client, None)
+
+    @asynccontextmanager
+    async def slot(self, client: str, cost: int):
+        """
+        Waits until a request of `client` may run. Requests with a lower
+        `cost` are let through first.
+        """
+        in_flight = self.in_flight.get(client, 0)
+        self.in_flight[client] = in_flight + 1
+
+        try:
+            await self.acquire((cost, in_flight, next(self.arrivals)))
+
+            started = time.monotonic()
+            try:
+                yield
+            finally:
+                elapsed = time.monotonic() - started
+                self.service_time += SMOOTHING * (elapsed - self.service_time)
+                self.release()
+        finally:
+            self.in_flight[client] -= 1
+            if not self.in_flight[client]:
+                del self.in_flight[client]
+
+    async def acquire(self, priority: Tuple[int, int, int]):
+        if self.active < self.budget and not self.queue:
+            self.active += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (*priority, waiter)
+        heapq.heappush(self.queue, entry)
+
+        try:
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # granted a slot we can no longer use
+                self.release()
+            else:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+            raise
+
+    def release(self):
+        self.active -= 1
+
+        while self.queue and self.active < self.budget:
+            waiter = heapq.heappop(self.queue)[-1]
+            if not waiter.done():
+                waiter.set_result(None)
+                self.active += 1
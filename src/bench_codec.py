@@ -0,0 +1,79 @@
+#!/bin/python
+
+# Compares the encode/decode cost and frame size of the available codecs for
+# typical LIST and RETRIEVE payloads.
+#
+#   python src/bench_codec.py --files 1000 --content 1024
+
+import argparse
+import base64
+import os
+import timeit
+
+import codec
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--files", type=int, help="entries in the LIST payload", default=1000,
+    )
+    parser.add_argument(
+        "--content",
+        metavar="KIB",
+        type=int,
+        help="file size in the RETRIEVE payload",
+        default=1024,
+    )
+    parser.add_argument(
+        "--number", type=int, help="repetitions per measurement", default=50,
+    )
+    return parser.parse_args()
+
+
+def list_payload(count):
+    return [
+        {
+            "filename": f"file-{i}.txt",
+            "hostname": f"10.0.{i % 256}.{i // 256 % 256}:1234",
+            "speed": "gigabit",
+        }
+        for i in range(count)
+    ]
+
+
+def retrieve_payload(chosen, data):
+    # JSON can't carry bytes, so the content is base64 encoded like FTPServer
+    # does for JSON connections
+    content = data if chosen.binary else base64.b64encode(data).decode("utf-8")
+    return {"filename": "file.bin", "content": content}
+
+
+def measure(chosen, payload, number):
+    encoded = chosen.encode(payload)
+
+    encode = timeit.timeit(lambda: chosen.encode(payload), number=number) / number
+    decode = timeit.timeit(lambda: chosen.decode(encoded), number=number) / number
+
+    return len(encoded), encode, decode
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    data = os.urandom(args.content * 1024)
+
+    payloads = [
+        ("LIST", lambda chosen: list_payload(args.files)),
+        ("RETRIEVE", lambda chosen: retrieve_payload(chosen, data)),
+    ]
+
+    print(f"{'payload':10}{'codec':10}{'frame':>12}{'encode':>12}{'decode':>12}")
+
+    for label, make_payload in payloads:
+        for chosen in codec.CODECS.values():
+            size, encode, decode = measure(chosen, make_payload(chosen), args.number)
+            print(
+                f"{label:10}{chosen.name:10}{size:>12}"
+                f"{encode * 1e6:>10.1f}us{decode * 1e6:>10.1f}us"
+            )
@@ -0,0 +1,107 @@
+#!/bin/python
+
+# Measures RETRIEVE throughput of the FTPServer with and without sendfile.
+#
+#   python src/bench_transfer.py --size 256 --rounds 5
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import common
+
+from ftp.ftp_server import FTPServer
+
+
+class NullSink:
+    """A file-like object that only counts the bytes written to it."""
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--size", metavar="MIB", type=int, help="size of the test file", default=256,
+    )
+    parser.add_argument(
+        "--rounds", type=int, help="downloads per transfer path", default=5,
+    )
+    parser.add_argument(
+        "--port", metavar="PORT", type=int, help="port to serve on", default=4321,
+    )
+    return parser.parse_args()
+
+
+async def download(port, filename):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+    await common.send_json(
+        writer, {"method": "RETRIEVE", "filename": filename, "mode": "stream"}
+    )
+    header = await common.recv_json(reader)
+
+    sink = NullSink()
+    await common.recv_file_body(reader, sink, header["length"])
+    await common.recv_json(reader)
+
+    writer.close()
+    await writer.wait_closed()
+
+    return sink.written
+
+
+async def bench(use_sendfile, port, filename, rounds):
+    server = await asyncio.start_server(
+        FTPServer(use_sendfile=use_sendfile).handle_request, "127.0.0.1", port
+    )
+
+    total = 0
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    for _ in range(rounds):
+        total += await download(port, filename)
+
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    # let the handlers notice the closed connections before shutting down
+    await asyncio.sleep(0.1)
+
+    server.close()
+    await server.wait_closed()
+
+    return total, elapsed, cpu
+
+
+async def main(args):
+    filename = "bench.bin"
+
+    with open(filename, "wb") as outfile:
+        for _ in range(args.size):
+            outfile.write(os.urandom(1024 * 1024))
+
+    for use_sendfile in (False, True):
+        total, elapsed, cpu = await bench(
+            use_sendfile, args.port, filename, args.rounds
+        )
+        label = "sendfile" if use_sendfile else "chunked"
+        print(
+            f"{label:10}{common.sizeof_fmt(total / elapsed)}/s"
+            f"  ({common.sizeof_fmt(total)} in {elapsed:.2f}s, cpu {cpu:.2f}s)"
+        )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        asyncio.run(main(args))
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from typing import Dict, Hashable, Set
+
+
+class LRUCache:
+    """
+    A least-recently-used cache bounded by the total size of its entries.
+
+    Every entry belongs to a group (for example the peer it came from), so
+    all entries of a group can be dropped at once when the group goes stale.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        # key -> (value, size, group), oldest first
+        self.entries: OrderedDict = OrderedDict()
+        self.groups: Dict[Hashable, Set[Hashable]] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: Hashable, default=None):
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Hashable, value, size: int, group: Hashable = None):
+        if size > self.max_bytes:
+            return
+
+        self.discard(key)
+
+        self.entries[key] = (value, size, group)
+        self.groups.setdefault(group, set()).add(key)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.discard(oldest)
+
+    def discard(self, key: Hashable):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        _, size, group = entry
+        self.size -= size
+
+        keys = self.groups[group]
+        keys.discard(key)
+        if not keys:
+            del self.groups[group]
+
+    def discard_group(self, group: Hashable):
+        for key in list(self.groups.get(group, ())):
+            self.discard(key)
@@ -0,0 +1,109 @@
+import sys
+
+from typing import Dict, Iterable, Iterator, Optional
+
+
+class FileRecord:
+    """
+    A single shared file. Kept as small as possible since the catalog holds
+    one of these for every file of every peer.
+    """
+
+    __slots__ = ("filename", "size", "mtime", "description", "sha256")
+
+    def __init__(
+        self,
+        filename: str,
+        size: Optional[int] = None,
+        mtime=None,
+        description: Optional[str] = None,
+        sha256: Optional[str] = None,
+    ):
+        self.filename = filename
+        self.size = size
+        self.mtime = mtime
+        self.description = description
+
+        # hex digest of the contents, once the peer has hashed the file
+        self.sha256 = sha256
+
+    @classmethod
+    def from_dict(cls, file: Dict):
+        return cls(
+            file["filename"],
+            file.get("size"),
+            file.get("mtime"),
+            file.get("description"),
+            file.get("sha256"),
+        )
+
+
+class Peer:
+    """
+    A connected client and the files it shares, by filename.
+    """
+
+    __slots__ = ("username", "hostname", "speed", "files", "generation", "last_seen")
+
+    def __init__(
+        self, username: str, hostname: str, speed: str, files: Iterable[FileRecord]
+    ):
+        # hostnames and speeds repeat across many records, share the strings
+        self.username = username
+        self.hostname = sys.intern(hostname)
+        self.speed = sys.intern(speed)
+        self.files: Dict[str, FileRecord] = {f.filename: f for f in files}
+
+        # the catalog generation this peer's files last changed in
+        self.generation = 0
+
+        # when the peer last sent a request, tracked once it sent a heartbeat
+        # so peers that never do aren't considered stale
+        self.last_seen: Optional[float] = None
+
+
+class Catalog:
+    """
+    Every connected peer by username.
+
+    Adding, finding and removing a peer together with all of its files are
+    O(1), since a peer's files are only reachable through the peer itself.
+    """
+
+    def __init__(self):
+        self.peers: Dict[str, Peer] = {}
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __iter__(self) -> Iterator[Peer]:
+        return iter(self.peers.values())
+
+    def get(self, username: str) -> Optional[Peer]:
+        return self.peers.get(username)
+
+    def add(self, peer: Peer) -> Optional[Peer]:
+        """
+        Adds a peer and returns the peer it replaced, if one was already
+        connected with the same username.
+        """
+        replaced = self.peers.get(peer.username)
+        self.peers[peer.username] = peer
+        return replaced
+
+    def remove(self, peer: Peer) -> bool:
+        """
+        Removes a peer, unless it was already replaced by a newer connection
+        with the same username. Returns whether it was removed.
+        """
+        if self.peers.get(peer.username) is not peer:
+            return False
+
+        del self.peers[peer.username]
+        return True
+
+    def others(self, username: str) -> Iterator[Peer]:
+        """
+        Returns every peer except the one with `username`.
+        """
+        return (peer for peer in self.peers.values() if peer.username != username)
@@ -4,6 +4,8 @@ import wx
 import common
 import asyncio
 import argparse
+import json
+import math
 import os
 import base64
 import time
@@ -13,38 +15,337 @@ from asyncio import StreamReader, StreamWriter
 from typing import Dict
 from wxasync import AsyncBind, WxAsyncApp, StartCoroutine, AsyncShowDialog
 from asyncio.events import get_event_loop
+from stat import S_ISREG
 
 from ftp.ftp_client import FTPClient
 from ftp.ftp_server import FTPServer
+from ftp.swarm import SwarmDownload
+from hashing import Hasher
 from client.gui import MyFrame
+from trigrams import encode_trigrams, file_trigrams
+from watcher import DirectoryWatcher
+
+
+# encoded size of the catalog entries sent in a single frame. Trigrams of a
+# text file take up to about 128 KiB, so this stays well below the server's
+# frame limit.
+CATALOG_BATCH_BYTES = 1024 * 1024
+
+# encoded size of an entry's size, mtime, hash and field names
+ENTRY_OVERHEAD = 160
+
+
+def file_descriptions(path="files.json"):
+    """
+    Returns the descriptions in the shared directory's `files.json` by
+    filename, if there is one.
+    """
+    try:
+        with open(path) as infile:
+            entries = json.load(infile).get("files", [])
+    except (OSError, ValueError):
+        return {}
+
+    return {
+        os.path.basename(e["filename"]): e["description"]
+        for e in entries
+        if e.get("filename") and e.get("description")
+    }
+
+
+def shared_file(filename, binary=False, descriptions=None, hasher=None):
+    """
+    Returns the catalog entry of a shared file, with the trigrams of its
+    contents so the server can answer keyword searches without asking us,
+    and its content hash if `hasher` already has it.
+
+    Trigrams are sent as raw bytes when `binary` is set, which requires a
+    codec that carries them. This reads the whole file, see `catalog_entries`.
+    """
+    file = dict(
+        filename=filename,
+        size=os.path.getsize(filename),
+        mtime=os.path.getmtime(filename),
+    )
 
+    if descriptions and filename in descriptions:
+        file["description"] = descriptions[filename]
 
-async def connect(
-    remote_host, remote_port, username, hostname, connection_speed, local_port
-):
+    found = file_trigrams(filename)
+    if found is not None:
+        file["trigrams"] = encode_trigrams(found, binary)
 
-    reader, writer = await asyncio.open_connection(remote_host, remote_port)
+    hashes = hasher.cached(filename) if hasher is not None else None
+    if hashes is not None:
+        file["sha256"] = hashes[0]
 
+    return file
+
+
+def read_entries(names, binary, descriptions, hasher):
     files = []
 
-    for f in os.listdir("."):
-        if os.path.isfile(f):
-            files.append(dict(filename=f))
-
-    await common.send_json(
-        writer,
-        {
-            "method": "CONNECT",
-            "username": username,
-            "hostname": hostname,
-            "port": local_port,
-            "speed": connection_speed,
-            "files": files,
-        },
+    for f in names:
+        try:
+            files.append(shared_file(f, binary, descriptions, hasher))
+        except OSError:
+            # removed again already, the next change reports it
+            continue
+
+    return files
+
+
+async def catalog_entries(names, binary=False, hasher=None):
+    """
+    Returns the catalog entries of the files in `names`. Reading the files
+    for their trigrams runs in a worker thread, so the GUI stays responsive
+    while a large library is read.
+    """
+    descriptions = file_descriptions()
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None, read_entries, names, binary, descriptions, hasher
+    )
+
+
+def catalog_batches(files):
+    """
+    Splits catalog entries into batches of about `CATALOG_BATCH_BYTES`
+    encoded, so no single frame grows past `common.MAX_FRAME_SIZE`.
+    """
+    batch = []
+    size = 0
+
+    for file in files:
+        entry_size = ENTRY_OVERHEAD + len(file["filename"])
+        entry_size += len(file.get("trigrams", ""))
+        entry_size += len(file.get("description", ""))
+
+        if batch and size + entry_size > CATALOG_BATCH_BYTES:
+            yield batch
+            batch = []
+            size = 0
+
+        batch.append(file)
+        size += entry_size
+
+    if batch:
+        yield batch
+
+
+def snapshot_files(names=None):
+    """
+    Returns the size and mtime of the shared files among `names`, or of every
+    shared file if `names` is `None`.
+    """
+    if names is None:
+        names = os.listdir(".")
+
+    snapshot = {}
+
+    for f in names:
+        if not common.is_shared(f):
+            continue
+
+        try:
+            stat = os.stat(f)
+        except OSError:
+            continue
+
+        if S_ISREG(stat.st_mode):
+            snapshot[f] = (stat.st_size, stat.st_mtime)
+
+    return snapshot
+
+
+def catalog_digest(snapshot):
+    """
+    Returns the digest of the catalog `catalog_entries` would send for the
+    files in `snapshot`, without reading the files.
+    """
+    descriptions = file_descriptions()
+
+    return common.catalog_digest(
+        (f, size, mtime, descriptions.get(f))
+        for f, (size, mtime) in snapshot.items()
     )
 
+
+async def publish_changes(
+    connection: common.MultiplexedConnection, watcher, hasher: Hasher, snapshot
+):
+    """
+    Sends the server an ADD, UPDATE or REMOVE for the files that were added,
+    changed or removed since `snapshot`, the files we connected with, as the
+    `watcher` reports them.
+
+    Files are hashed before they are sent. Files that weren't hashed yet when
+    we connected are hashed first and only their hashes are sent.
+    """
+    snapshot = dict(snapshot)
+
+    # changes made while hashing are reported once we iterate the watcher,
+    # and the directory is checked once for those made before it started
+    watcher.start()
+
+    try:
+        hasher.cache.prune(snapshot)
+
+        unhashed = [f for f in snapshot if hasher.cached(f) is None]
+        if unhashed:
+            await hasher.hash_files(unhashed)
+            await send_hashes(connection, unhashed, snapshot, hasher)
+
+        async for changed in watcher.changes(rescan=True):
+            if changed is None:
+                changed = set(snapshot) | set(os.listdir("."))
+
+            current = snapshot_files(changed)
+            descriptions = file_descriptions()
+
+            added = [f for f in current if f not in snapshot]
+            updated = [
+                f for f in current if f in snapshot and current[f] != snapshot[f]
+            ]
+            removed = [f for f in changed if f in snapshot and f not in current]
+
+            # new descriptions are picked up by resending the files they describe
+            if "files.json" in changed:
+                updated.extend(
+                    f
+                    for f in descriptions
+                    if f in snapshot and f not in current and os.path.isfile(f)
+                )
+
+            for f in removed:
+                del snapshot[f]
+            snapshot.update(current)
+
+            await hasher.hash_files(added + updated)
+
+            await send_files(connection, "ADD", added, hasher)
+            await send_files(connection, "UPDATE", updated, hasher)
+
+            if removed:
+                await connection.send({"method": "REMOVE", "filenames": removed})
+    finally:
+        # only needed if we stopped before the watcher was iterated
+        watcher.close()
+
+
+async def send_files(connection: common.MultiplexedConnection, method, names, hasher):
+    """
+    Sends the catalog entries of the files in `names` as ADDs or UPDATEs.
+    """
+    binary = common.get_codec(connection.writer).binary
+
+    files = await catalog_entries(names, binary, hasher)
+
+    for batch in catalog_batches(files):
+        await connection.send({"method": method, "files": batch})
+
+
+async def send_hashes(
+    connection: common.MultiplexedConnection, names, snapshot, hasher: Hasher
+):
+    """
+    Sends the content hashes of the files in `names` as HASHES, for the
+    versions of the files in `snapshot` the server already has.
+    """
+    files = []
+
+    for f in names:
+        size, mtime = snapshot[f]
+
+        hashes = hasher.cache.get(f, size, mtime)
+        if hashes is None:
+            continue
+
+        files.append(dict(filename=f, size=size, mtime=mtime, sha256=hashes[0]))
+
+    for batch in catalog_batches(files):
+        await connection.send({"method": "HASHES", "files": batch})
+
+
+async def send_heartbeats(connection: common.MultiplexedConnection, interval=15):
+    """
+    Periodically tells the server we're still here. Each heartbeat carries
+    the round trip time of the previous one, which the server uses to rank
+    us against other peers.
+    """
+    rtt = None
+
+    while True:
+        started = time.monotonic()
+
+        try:
+            await asyncio.wait_for(
+                connection.request({"method": "HEARTBEAT", "rtt": rtt}), interval
+            )
+            rtt = time.monotonic() - started
+        except asyncio.TimeoutError:
+            print("The server did not answer a heartbeat")
+            rtt = None
+        except ConnectionResetError:
+            print("Lost the connection to the server")
+            return
+
+        await asyncio.sleep(interval)
+
+
+async def connect(
+    remote_host,
+    remote_port,
+    username,
+    hostname,
+    connection_speed,
+    local_port,
+    hasher=None,
+):
+
+    reader, writer = await asyncio.open_connection(remote_host, remote_port)
+    common.configure_transport(writer)
+
+    chosen = await common.negotiate_codec(reader, writer)
+
+    # the files the server learns about, changes made after this are
+    # published once we're connected
+    snapshot = snapshot_files()
+
+    request = {
+        "method": "CONNECT",
+        "username": username,
+        "hostname": hostname,
+        "port": local_port,
+        "speed": connection_speed,
+        "digest": catalog_digest(snapshot),
+    }
+
+    # the server may still have our catalog from before a reconnect, only
+    # send it if it asks for it
+    await common.send_json(writer, request)
     response = await common.recv_json(reader)
 
+    if response is not None and response.get("files_required"):
+        files = await catalog_entries(list(snapshot), chosen.binary, hasher)
+
+        # the first batch goes along with the CONNECT, the rest follows in
+        # ADDs so a large library doesn't exceed the frame size
+        batches = list(catalog_batches(files)) or [[]]
+
+        request["files"] = batches[0]
+        await common.send_json(writer, request)
+        response = await common.recv_json(reader)
+
+        if response is not None and response.get("error") is None:
+            for batch in batches[1:]:
+                await common.send_json(writer, {"method": "ADD", "files": batch})
+
+    if response is None:
+        print("The server closed the connection")
+        return
+
     error = response.get("error")
     if error is not None:
         print(f"An error ocurred: {error}")
@@ -52,7 +353,7 @@ async def connect(
     else:
         print("Connected to remote server")
 
-    return reader, writer
+    return reader, writer, snapshot
 
 
 def parse_args():
@@ -60,9 +361,36 @@ def parse_args():
     parser.add_argument(
         "--port", metavar="PORT", type=int, help="port to serve files on", default=1234,
     )
+    parser.add_argument(
+        "--upload-rate",
+        metavar="KIB",
+        type=int,
+        help="KiB per second sent to all peers together, unlimited by default",
+    )
+    parser.add_argument(
+        "--connection-rate",
+        metavar="KIB",
+        type=int,
+        help="KiB per second sent to a single peer, unlimited by default",
+    )
+    parser.add_argument(
+        "--upload-slots",
+        metavar="FILES",
+        type=int,
+        help="files sent at once, further requests are queued",
+        default=4,
+    )
     return parser.parse_args()
 
 
+def kib(value):
+    return value * 1024 if value is not None else None
+
+
+# files per frame when streaming the file listing from the server
+LIST_PAGE_SIZE = 200
+
+
 class ErrorDialog(wx.Dialog):
 
     message = ""
@@ -95,8 +423,20 @@ class MyApp(WxAsyncApp):
 
     server_connection = None
 
+    # background task keeping the server's index of our files up to date
+    index_publisher = None
+
+    # background task sending the server heartbeats
+    heartbeat = None
+
     ftp_client = None
 
+    # content hashes of our files, shared by the file server and the catalog
+    hasher = None
+
+    # the files shown by the last LIST or KEYWORD search
+    files = []
+
     args = parse_args()
 
     def OnInit(self):
@@ -108,6 +448,8 @@ class MyApp(WxAsyncApp):
         self.frame.hostname.SetValue(f"127.0.0.1:{args.port}")
 
         self.ftp_client = FTPClient(self.frame.ftp_output)
+        self.ftp_client.on_transfer = self.report_transfer
+        self.hasher = Hasher()
 
         StartCoroutine(self.run_file_server_in_background, self)
 
@@ -159,18 +501,24 @@ class MyApp(WxAsyncApp):
                     widget.Enable()
 
     async def run_file_server_in_background(self):
-        server = FTPServer()
+        server = FTPServer(
+            hasher=self.hasher,
+            upload_rate=kib(args.upload_rate),
+            connection_rate=kib(args.connection_rate),
+            upload_slots=args.upload_slots,
+        )
 
         server_task = asyncio.create_task(server.run_forever(args.port))
 
     async def OnDisconnect(self, event):
         print("disconnecting")
-        try:
-            (_, writer) = self.server_connection
-            writer.close()
-            await writer.wait_closed()
-        except ConnectionResetError:
-            pass
+        if self.index_publisher is not None:
+            self.index_publisher.cancel()
+            self.index_publisher = None
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            self.heartbeat = None
+        await self.server_connection.close()
         self.server_connection = None
         self.update_gui()
 
@@ -204,17 +552,28 @@ class MyApp(WxAsyncApp):
         print(server_hostname, server_port, username, hostname, connection_speed)
 
         try:
-            reader, writer = await connect(
+            reader, writer, snapshot = await connect(
                 server_hostname,
                 server_port,
                 username,
                 hostname,
                 connection_speed,
                 local_port=1234,
+                hasher=self.hasher,
             )
             print("connected successfully")
 
-            self.server_connection = (reader, writer)
+            # requests on the connection are multiplexed, so a slow keyword
+            # search doesn't block listing files
+            self.server_connection = common.MultiplexedConnection(reader, writer)
+            self.index_publisher = asyncio.create_task(
+                publish_changes(
+                    self.server_connection, DirectoryWatcher(), self.hasher, snapshot
+                )
+            )
+            self.heartbeat = asyncio.create_task(
+                send_heartbeats(self.server_connection)
+            )
 
         except Exception:
             dlg = ErrorDialog("Failed to connect, is the host online?")
@@ -227,21 +586,75 @@ class MyApp(WxAsyncApp):
         keyword = self.frame.search_input.GetValue()
         self.frame.search_input.SetValue("")
 
-        # Get the files
-        (reader, writer) = self.server_connection
+        listctrl = self.frame.search_output
+        listctrl.DeleteAllItems()
+        self.files = []
 
         if keyword == "":
-            await common.send_json(writer, {"method": "LIST",})
+            # stream the listing a page at a time so the first results show
+            # up before the whole catalog has been sent
+            async for page in self.server_connection.stream(
+                {
+                    "method": "LIST",
+                    "page_size": LIST_PAGE_SIZE,
+                    "stream": True,
+                    "sort": "fastest",
+                }
+            ):
+                self.show_files(page["files"])
+            return
+
+        # "name:" searches filenames instead of contents, as do patterns
+        if keyword.startswith("name:"):
+            find = {"method": "FIND", "query": keyword[5:], "mode": "fuzzy"}
+        elif any(c in keyword for c in "*?["):
+            find = {"method": "FIND", "query": keyword, "mode": "glob"}
         else:
-            await common.send_json(writer, {"method": "KEYWORD", "keyword": keyword,})
+            find = None
 
-        response = await common.recv_json(reader)
+        if find is not None:
+            response = await self.server_connection.request(find)
+            if not self.rejected(response):
+                self.show_files(response["files"])
+            return
+
+        response = await self.server_connection.request(
+            {"method": "KEYWORD", "keyword": keyword,}
+        )
+
+        if self.rejected(response):
+            return
+
+        if response["failed"]:
+            self.ftp_client.error(
+                f"Search skipped unresponsive peers: {', '.join(response['failed'])}"
+            )
+
+        self.show_files(response["files"])
+
+    def rejected(self, response):
+        """
+        Shows why the server turned down a search, if it did.
+        """
+        retry_after = response.get("retry_after")
+
+        if retry_after is None:
+            return False
+
+        self.ftp_client.error(
+            f"The server is busy, search again in {math.ceil(retry_after)} seconds"
+        )
+        return True
+
+    def show_files(self, files):
+        """
+        Appends files to the ListCtrl.
+        """
+        self.files.extend(files)
 
-        # Update the ListCtrl
         listctrl = self.frame.search_output
-        listctrl.DeleteAllItems()
 
-        for file in response:
+        for file in files:
             filename = file["filename"]
             hostname = file["hostname"]
             speed = file["speed"]
@@ -266,7 +679,57 @@ class MyApp(WxAsyncApp):
         cmd = self.frame.ftp_input.GetValue()
         self.frame.ftp_input.SetValue("")
 
-        await self.ftp_client.try_command(cmd)
+        if cmd.upper().startswith("SWARM"):
+            await self.swarm(cmd)
+        else:
+            await self.ftp_client.try_command(cmd)
+
+    async def swarm(self, command):
+        """
+        Handles `SWARM <FILENAME> [<HOST:PORT> ...]`. Without explicit hosts
+        every peer listing the file in the last search is used as a source.
+        """
+        self.ftp_client.info(f"> {command}")
+
+        cmd = command.split()
+
+        if len(cmd) < 2:
+            self.ftp_client.error("SWARM requires a <FILENAME> parameter")
+            return
+
+        filename = cmd[1]
+        sources = cmd[2:]
+
+        if not sources:
+            sources = [f["hostname"] for f in self.files if f["filename"] == filename]
+
+        if not sources:
+            self.ftp_client.error(f"No peers are known to hold {filename}")
+            return
+
+        await SwarmDownload(
+            filename, sources, self.frame.ftp_output, self.report_transfer
+        ).run()
+
+    def report_transfer(self, hostname, size, seconds, success):
+        """
+        Tells the server how a download from a peer went, so it can rank the
+        peer by what it actually delivers.
+        """
+        if self.server_connection is None:
+            return
+
+        asyncio.create_task(
+            self.server_connection.send(
+                {
+                    "method": "REPORT",
+                    "hostname": hostname,
+                    "size": size,
+                    "seconds": seconds,
+                    "success": success,
+                }
+            )
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONCodec:
+    """
+    UTF-8 encoded JSON. Binary data has to be base64 encoded by the sender.
+    """
+
+    name = "json"
+
+    # whether raw bytes can be sent as message fields
+    binary = False
+
+    def encode(self, body) -> bytes:
+        return json.dumps(body).encode("utf-8")
+
+    def decode(self, data: bytes):
+        return json.loads(data.decode("utf-8"))
+
+    def encode_items(self, items) -> bytes:
+        """
+        Encodes a run of array items that `join_items` can splice into an
+        array without decoding them again.
+        """
+        return b",".join(self.encode(item) for item in items)
+
+    def join_items(self, fragments, count: int) -> bytes:
+        return b"[" + b",".join(f for f in fragments if f) + b"]"
+
+    def wrap_envelope(self, request_id, payload: bytes) -> bytes:
+        return b'{"id": ' + self.encode(request_id) + b', "body": ' + payload + b"}"
+
+
+class MsgpackCodec:
+    """
+    MessagePack. More compact and faster than JSON, and carries raw bytes.
+    """
+
+    name = "msgpack"
+    binary = True
+
+    def encode(self, body) -> bytes:
+        return msgpack.packb(body, use_bin_type=True)
+
+    def decode(self, data: bytes):
+        return msgpack.unpackb(data, raw=False)
+
+    def encode_items(self, items) -> bytes:
+        return b"".join(self.encode(item) for item in items)
+
+    def join_items(self, fragments, count: int) -> bytes:
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 2 ** 16:
+            header = b"\xdc" + count.to_bytes(2, "big")
+        else:
+            header = b"\xdd" + count.to_bytes(4, "big")
+
+        return header + b"".join(fragments)
+
+    def wrap_envelope(self, request_id, payload: bytes) -> bytes:
+        # a two entry map, {"id": request_id, "body": payload}
+        return (
+            b"\x82"
+            + self.encode("id")
+            + self.encode(request_id)
+            + self.encode("body")
+            + payload
+        )
+
+
+JSON = JSONCodec()
+
+# codecs this process can speak, most preferred first
+CODECS = {}
+
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+CODECS[JSON.name] = JSON
+
+
+def negotiate(offered):
+    """
+    Picks the codec to use from the names a peer offered, preferring ours.
+    Falls back to JSON, which every peer speaks.
+    """
+    for name, codec in CODECS.items():
+        if name in offered:
+            return codec
+
+    return JSON
@@ -1,15 +1,22 @@
+import asyncio
 import base64
+import hashlib
 import json
+import mmap
 import os
 import socket
 import struct
 import threading
+import weakref
+
+import codec
 
 from asyncio import StreamWriter, StreamReader
-from asyncio.streams import IncompleteReadError
+from asyncio import IncompleteReadError
 
 
 from enum import Enum
+from typing import Dict, Union
 
 
 class Event(Enum):
@@ -22,6 +29,146 @@ class ConnectionSpeed(str, Enum):
     GIGABIT = "gigabit"
 
 
+# size of each raw chunk written during a streamed file transfer
+CHUNK_SIZE = 64 * 1024
+
+# size of the byte ranges a file is split into for multi-source downloads
+PIECE_SIZE = 1024 * 1024
+
+# sidecar file in the shared directory caching the content hashes of the
+# shared files, never shared itself
+HASH_CACHE = ".hashes.json"
+
+# frames announcing a larger body than this are refused and the connection is
+# dropped, so a bad length prefix can't make us allocate gigabytes
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# writers wait for the transport buffer to drop below the low water mark once
+# it grows past the high water mark
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+
+
+def partial_path(filename: str, size: int):
+    """
+    Returns the path an in-progress upload of `filename` is written to before
+    it is renamed into place. The expected size is part of the name so an
+    interrupted upload is only resumed by an upload of the same size.
+    """
+    directory, name = os.path.split(filename)
+    return os.path.join(directory, f".{name}.{size}.part")
+
+
+def swarm_path(filename: str, size: int):
+    """
+    Returns the path a swarm download of `filename` is assembled in. It is
+    sized up front and filled in piece by piece, so its length says nothing
+    about how much was downloaded, and the name keeps it apart from other
+    partial files.
+    """
+    directory, name = os.path.split(filename)
+    return os.path.join(directory, f".{name}.{size}.swarm.part")
+
+
+def download_path(filename: str, size: int, mtime_ns: int):
+    """
+    Returns the path a download of `filename` is written to until it is
+    complete. The remote file's size and mtime are part of the name, so a
+    download is only resumed from the same version of the file, and the name
+    differs from those of uploads and swarm downloads.
+    """
+    directory, name = os.path.split(filename)
+    return os.path.join(directory, f".{name}.{size}-{mtime_ns}.download.part")
+
+
+def find_download(filename: str):
+    """
+    Returns the path and the remote size and mtime of an interrupted download
+    of `filename`, or `None` if there is none.
+    """
+    directory, name = os.path.split(filename)
+    prefix = f".{name}."
+    suffix = ".download.part"
+
+    for entry in os.listdir(directory or "."):
+        if not entry.startswith(prefix) or not entry.endswith(suffix):
+            continue
+
+        version = entry[len(prefix) : -len(suffix)].split("-")
+        if len(version) == 2 and all(part.isdigit() for part in version):
+            return os.path.join(directory, entry), int(version[0]), int(version[1])
+
+    return None
+
+
+def is_partial(filename: str):
+    return filename.endswith(".part")
+
+
+def is_shared(filename: str):
+    """
+    Returns whether a file in the shared directory is offered to other peers,
+    leaving out unfinished uploads and our own bookkeeping.
+    """
+    return not is_partial(filename) and os.path.basename(filename) != HASH_CACHE
+
+
+def hash_pieces(infile, piece_size: int = PIECE_SIZE):
+    """
+    Hashes a file one piece at a time and returns the sha256 hex digest of the
+    whole file together with the digest of every piece.
+    """
+    whole = hashlib.sha256()
+    pieces = []
+
+    while True:
+        piece = hashlib.sha256()
+        remaining = piece_size
+
+        while remaining > 0:
+            chunk = infile.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+
+            piece.update(chunk)
+            whole.update(chunk)
+            remaining -= len(chunk)
+
+        if remaining == piece_size:
+            break
+
+        pieces.append(piece.hexdigest())
+
+        if remaining > 0:
+            break
+
+    return whole.hexdigest(), pieces
+
+
+def catalog_digest(entries):
+    """
+    Returns a digest of a catalog given as `(filename, size, mtime,
+    description)` tuples. Peers and the server compute it the same way, so
+    equal digests mean the server already has the peer's catalog.
+    """
+    encoded = json.dumps(sorted(entries, key=lambda e: e[0])).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def file_contains(path: str, needle: bytes):
+    """
+    Returns whether the file at `path` contains `needle`. The file is mapped
+    into memory instead of being read, so large files are searched without
+    loading them.
+    """
+    with open(path, "rb") as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return needle == b""
+
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return mapped.find(needle) != -1
+
+
 # https://stackoverflow.com/questions/1094841/reusable-library-to-get-human-readable-version-of-file-size
 def sizeof_fmt(num, suffix="B"):
     for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
@@ -33,29 +180,290 @@ def sizeof_fmt(num, suffix="B"):
 
 async def recv_json(reader: StreamReader):
     """
-    Reads a 4 byte length-prefixed JSON message and returns a decoded JSON object.
+    Reads a 4 byte length-prefixed message and returns it decoded with the
+    connection's codec (JSON unless another one was negotiated).
 
-    If the reader fails to read the message, `None` is returned. 
+    If the reader fails to read the message, or the message is larger than
+    `MAX_FRAME_SIZE`, `None` is returned.
     """
     try:
         raw_length = await reader.readexactly(4)
         length = struct.unpack(">I", raw_length)[0]
 
-        body = bytes()
-        while len(body) != length:
-            body += await reader.read(length)
+        if length > MAX_FRAME_SIZE:
+            print(
+                f"Refusing a {sizeof_fmt(length)} frame, the limit is {sizeof_fmt(MAX_FRAME_SIZE)}"
+            )
+            return None
 
-        body = body.decode("utf-8")
-        return json.loads(body)
+        # read straight into a buffer of the final size instead of growing one
+        body = bytearray(length)
+        view = memoryview(body)
+        received = 0
+
+        while received < length:
+            chunk = await reader.read(min(length - received, CHUNK_SIZE))
+            if not chunk:
+                raise IncompleteReadError(bytes(view[:received]), length)
+
+            view[received : received + len(chunk)] = chunk
+            received += len(chunk)
+
+        return get_codec(reader).decode(body)
     except IncompleteReadError:
         return None
 
 
+def configure_transport(writer: StreamWriter):
+    """
+    Sets the write buffer limits `send_json` waits on for a new connection.
+    """
+    writer.transport.set_write_buffer_limits(high=HIGH_WATER, low=LOW_WATER)
+
+
+# serializes waiting for the write buffer on connections shared by several
+# tasks, since older Pythons only allow one drain() at a time
+drain_locks = weakref.WeakKeyDictionary()
+
+
+async def drain(writer: StreamWriter):
+    if isinstance(writer, TaggedWriter):
+        writer = writer.writer
+
+    lock = drain_locks.get(writer)
+    if lock is None:
+        lock = drain_locks[writer] = asyncio.Lock()
+
+    async with lock:
+        await writer.drain()
+
+
+# the codec negotiated for each connection, by its reader and writer.
+# Connections that never negotiated use JSON.
+connection_codecs = weakref.WeakKeyDictionary()
+
+
+def get_codec(stream):
+    if isinstance(stream, TaggedWriter):
+        stream = stream.writer
+
+    return connection_codecs.get(stream, codec.JSON)
+
+
+def set_codec(reader: StreamReader, writer: StreamWriter, chosen):
+    if isinstance(writer, TaggedWriter):
+        writer = writer.writer
+
+    connection_codecs[reader] = chosen
+    connection_codecs[writer] = chosen
+
+
+async def negotiate_codec(reader: StreamReader, writer: StreamWriter):
+    """
+    Offers the remote every codec we support and switches the connection to
+    the one it picks. Remotes that don't know HELLO answer with an error and
+    the connection stays on JSON.
+    """
+    await send_json(writer, {"method": "HELLO", "codecs": list(codec.CODECS)})
+
+    response = await recv_json(reader)
+
+    chosen = codec.JSON
+    if isinstance(response, dict):
+        chosen = codec.CODECS.get(response.get("codec"), codec.JSON)
+
+    set_codec(reader, writer, chosen)
+    return chosen
+
+
+async def accept_codec(request, reader: StreamReader, writer: StreamWriter):
+    """
+    Answers a HELLO request. The answer is still sent with the old codec,
+    everything after it uses the new one.
+    """
+    chosen = codec.negotiate(request.get("codecs", []))
+
+    await send_json(writer, {"codec": chosen.name})
+
+    set_codec(reader, writer, chosen)
+
+
+def encode_binary(writer: StreamWriter, data: bytes):
+    """
+    Prepares binary data for a message field, as raw bytes if the connection's
+    codec carries them and base64 otherwise.
+    """
+    if get_codec(writer).binary:
+        return data
+
+    return base64.b64encode(data).decode("utf-8")
+
+
+def decode_binary(value):
+    """
+    Reverses `encode_binary` whichever codec the value was sent with.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+
+    return base64.b64decode(value)
+
+
+class TaggedWriter:
+    """
+    Wraps a StreamWriter so every message sent through `send_json` is put in
+    an envelope carrying the id of the request it answers. Everything else is
+    passed through to the wrapped writer.
+    """
+
+    def __init__(self, writer: StreamWriter, request_id):
+        self.writer = writer
+        self.request_id = request_id
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+def is_envelope(message):
+    """
+    Returns whether a message is a `{"id": ..., "body": ...}` envelope rather
+    than a bare lockstep message.
+    """
+    return isinstance(message, dict) and "id" in message and "body" in message
+
+
+class MultiplexedConnection:
+    """
+    Lets many requests be outstanding on one connection at once.
+
+    Each request is sent in an envelope with a fresh id, and a background
+    task hands every tagged response to the request waiting for it, in
+    whatever order they arrive. Requests answered with several frames are
+    read with `stream`.
+    """
+
+    def __init__(self, reader: StreamReader, writer: StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+        self.next_id = 0
+        # a future for plain requests, a queue for streamed ones
+        self.pending: Dict[int, Union[asyncio.Future, asyncio.Queue]] = {}
+
+        self.task = asyncio.create_task(self.read_forever())
+
+    async def request(self, body):
+        """
+        Sends a request and waits for its response.
+        """
+        if self.task.done():
+            raise ConnectionResetError("connection closed")
+
+        self.next_id += 1
+        request_id = self.next_id
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+
+        try:
+            await send_json(self.writer, {"id": request_id, "body": body})
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def stream(self, body):
+        """
+        Sends a request answered with several frames and yields each frame as
+        it arrives, up to and including the one marked `"done"`.
+        """
+        if self.task.done():
+            raise ConnectionResetError("connection closed")
+
+        self.next_id += 1
+        request_id = self.next_id
+
+        queue = asyncio.Queue()
+        self.pending[request_id] = queue
+
+        try:
+            await send_json(self.writer, {"id": request_id, "body": body})
+
+            while True:
+                frame = await queue.get()
+                if frame is None:
+                    raise ConnectionResetError("connection closed")
+
+                yield frame
+
+                # errors and other single frame answers end the stream too
+                if not isinstance(frame, dict) or frame.get("done", True):
+                    break
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def send(self, body):
+        """
+        Sends a message that doesn't expect a response.
+        """
+        await send_json(self.writer, body)
+
+    async def read_forever(self):
+        try:
+            while True:
+                message = await recv_json(self.reader)
+
+                if message is None:
+                    break
+
+                if not is_envelope(message):
+                    print(f"Ignoring untagged message: {message}")
+                    continue
+
+                waiter = self.pending.get(message["id"])
+                if isinstance(waiter, asyncio.Queue):
+                    waiter.put_nowait(message["body"])
+                elif waiter is not None and not waiter.done():
+                    waiter.set_result(message["body"])
+        finally:
+            for waiter in self.pending.values():
+                if isinstance(waiter, asyncio.Queue):
+                    waiter.put_nowait(None)
+                elif not waiter.done():
+                    waiter.set_exception(ConnectionResetError("connection closed"))
+
+    async def close(self):
+        self.task.cancel()
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except ConnectionResetError:
+            pass
+
+
 async def send_json(writer: StreamWriter, body):
-    # encode the data as stringified-json
-    encoded = json.dumps(body)
-    encoded = encoded.encode("utf-8")
+    if isinstance(writer, TaggedWriter):
+        body = {"id": writer.request_id, "body": body}
+        writer = writer.writer
+
+    # encode the data with the connection's codec
+    encoded = get_codec(writer).encode(body)
+
+    await send_frame(writer, encoded)
+
+
+async def send_encoded(writer: StreamWriter, payload: bytes):
+    """
+    Sends a message that was already encoded with the connection's codec,
+    wrapping it in an envelope if it answers a tagged request.
+    """
+    if isinstance(writer, TaggedWriter):
+        payload = get_codec(writer).wrap_envelope(writer.request_id, payload)
+        writer = writer.writer
+
+    await send_frame(writer, payload)
+
 
+async def send_frame(writer: StreamWriter, encoded: bytes):
     # get the size of the encoded body
     size = struct.pack(">I", len(encoded))
 
@@ -65,6 +473,143 @@ async def send_json(writer: StreamWriter, body):
     # write the encoded body
     writer.write(encoded)
 
+    # wait while the peer is slower than us
+    await drain(writer)
+
+
+async def send_file_body(
+    writer: StreamWriter, infile, size: int, disk=None, throttle=None
+):
+    """
+    Writes `size` raw bytes from `infile` to the writer in fixed size chunks.
+
+    With a `disk` executor the file is read in its threads, and the next
+    chunk is read while the current one is sent. `throttle` is awaited with
+    the size of every chunk before it is sent, to limit the rate.
+
+    Returns the number of bytes actually sent, which is less than `size` if
+    the file was truncated while it was being sent.
+    """
+    if disk is None:
+        sent = 0
+        while sent < size:
+            chunk = infile.read(min(CHUNK_SIZE, size - sent))
+            if not chunk:
+                break
+
+            if throttle is not None:
+                await throttle(len(chunk))
+
+            writer.write(chunk)
+            await drain(writer)
+            sent += len(chunk)
+
+        return sent
+
+    loop = asyncio.get_running_loop()
+
+    sent = 0
+    reading = loop.run_in_executor(disk, infile.read, min(CHUNK_SIZE, size))
+
+    try:
+        while sent < size:
+            chunk = await reading
+            reading = None
+            if not chunk:
+                break
+
+            sent += len(chunk)
+            if sent < size:
+                reading = loop.run_in_executor(
+                    disk, infile.read, min(CHUNK_SIZE, size - sent)
+                )
+
+            if throttle is not None:
+                await throttle(len(chunk))
+
+            writer.write(chunk)
+            await drain(writer)
+    finally:
+        # don't let the file be closed under a read that's still running
+        if reading is not None:
+            await asyncio.wait([reading])
+
+    return sent
+
+
+async def sendfile_body(writer: StreamWriter, infile, size: int, throttle=None):
+    """
+    Sends `size` bytes from `infile`, starting at its current position, with
+    the kernel's sendfile. Falls back to `send_file_body` when the transport
+    doesn't support sendfile (for example SSL or non-socket transports).
+
+    With a `throttle` the file is sent one chunk at a time, awaiting it with
+    the size of each chunk first.
+    """
+    if size == 0:
+        return 0
+
+    loop = asyncio.get_running_loop()
+    start = infile.tell()
+
+    try:
+        if throttle is None:
+            return await loop.sendfile(
+                writer.transport, infile, start, size, fallback=False
+            )
+
+        sent = 0
+        while sent < size:
+            count = min(CHUNK_SIZE, size - sent)
+            await throttle(count)
+
+            chunk_sent = await loop.sendfile(
+                writer.transport, infile, start + sent, count, fallback=False
+            )
+            sent += chunk_sent
+
+            if chunk_sent < count:
+                break
+
+        return sent
+    except (NotImplementedError, asyncio.SendfileNotAvailableError):
+        infile.seek(start)
+        return await send_file_body(writer, infile, size, throttle=throttle)
+
+
+async def recv_file_body(reader: StreamReader, outfile, size: int, disk=None):
+    """
+    Reads exactly `size` raw bytes from the reader and writes them to `outfile`
+    one chunk at a time.
+
+    With a `disk` executor the chunks are written in its threads, while the
+    next chunk is being received.
+
+    Raises `IncompleteReadError` if the connection closes early.
+    """
+    loop = asyncio.get_running_loop()
+
+    received = 0
+    writing = None
+
+    try:
+        while received < size:
+            chunk = await reader.readexactly(min(CHUNK_SIZE, size - received))
+
+            if disk is None:
+                outfile.write(chunk)
+            else:
+                if writing is not None:
+                    await writing
+                writing = loop.run_in_executor(disk, outfile.write, chunk)
+
+            received += len(chunk)
+    finally:
+        if writing is not None:
+            await writing
+
+    return received
+
 
 async def send_response(writer: StreamWriter, body):
     await send_json(writer, body)
@@ -0,0 +1,77 @@
+import os
+import threading
+
+from stat import S_ISREG
+from typing import Dict, Iterable, Optional, Set
+
+
+class DirectoryCache:
+    """
+    The stat results of the files in a directory.
+
+    The directory is only listed again when its mtime changes, which happens
+    whenever a file is created, removed or renamed in it. Files that change in
+    place don't touch the directory, so they are reported with `invalidate`,
+    for example by a `DirectoryWatcher`, and only those are stat'ed again.
+
+    Listing runs in worker threads, so the cache is guarded by a lock.
+    """
+
+    def __init__(self, path="."):
+        self.path = path
+
+        # st_mtime_ns of the directory when it was last listed
+        self.mtime: Optional[int] = None
+
+        self.files: Dict[str, os.stat_result] = {}
+        self.stale: Set[str] = set()
+
+        self.lock = threading.Lock()
+
+    def invalidate(self, names: Optional[Iterable[str]] = None):
+        """
+        Marks files as changed, or the whole directory if `names` is `None`.
+        """
+        with self.lock:
+            if names is None:
+                self.mtime = None
+            else:
+                self.stale.update(names)
+
+    def listing(self) -> Dict[str, os.stat_result]:
+        """
+        Returns the stat result of every file in the directory by name. This
+        blocks on the file system and is meant to run in a worker thread.
+        """
+        with self.lock:
+            mtime = os.stat(self.path).st_mtime_ns
+
+            if mtime != self.mtime:
+                self.files = {}
+                with os.scandir(self.path) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_file():
+                                self.files[entry.name] = entry.stat()
+                        except OSError:
+                            # removed while we were listing
+                            continue
+
+                self.mtime = mtime
+                self.stale.clear()
+
+            for name in self.stale:
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    self.files.pop(name, None)
+                    continue
+
+                if S_ISREG(stat.st_mode):
+                    self.files[name] = stat
+                else:
+                    self.files.pop(name, None)
+
+            self.stale.clear()
+
+            return dict(self.files)
@@ -1,8 +1,10 @@
 import asyncio
 import os
 import common
-import base64
-import wx
+import io
+import time
+
+from asyncio import IncompleteReadError
 
 
 class FTPClient:
@@ -11,23 +13,32 @@ class FTPClient:
 
     output = None
 
+    # the "host:port" of the remote once connected
+    hostname = None
+
+    # called with the hostname, size, seconds and success of every download,
+    # so they can be reported to the index server
+    on_transfer = None
+
     def __init__(self, output=None):
         self.output = output
         pass
 
     def info(self, msg):
-        if self.output:
-            self.output.SetDefaultStyle(wx.TextAttr(wx.BLACK))
-            self.output.AppendText(f"{msg}\n")
+        self.write(msg, (0, 0, 0))
 
     def error(self, msg):
-        if self.output:
-            self.output.SetDefaultStyle(wx.TextAttr(wx.RED))
-            self.output.AppendText(f"{msg}\n")
+        self.write(msg, (255, 0, 0))
 
     def success(self, msg):
+        self.write(msg, (0, 100, 0))
+
+    def write(self, msg, colour):
         if self.output:
-            self.output.SetDefaultStyle(wx.TextAttr(wx.Colour(0, 100, 0)))
+            # only the GUI passes an output, so the server runs without wx
+            import wx
+
+            self.output.SetDefaultStyle(wx.TextAttr(wx.Colour(*colour)))
             self.output.AppendText(f"{msg}\n")
 
     def column_print(self, columns):
@@ -100,10 +111,13 @@ class FTPClient:
             return
         try:
             self.reader, self.writer = await asyncio.open_connection(address, port)
+            common.configure_transport(self.writer)
+            await common.negotiate_codec(self.reader, self.writer)
         except Exception as e:
             self.error(f"Failed to connect: {e}")
             return
 
+        self.hostname = f"{address}:{port}"
         self.success(f"Successfully connected to {address}:{port}")
 
     async def disconnect(self):
@@ -150,51 +164,177 @@ class FTPClient:
             return
 
         with open(filename, "rb") as infile:
-            contents = infile.read()
-
-            # base64 encode the binary file
-            contents = base64.b64encode(contents).decode("utf-8")
+            size = os.fstat(infile.fileno()).st_size
 
             try:
                 await self.send_json(
-                    {"method": "STORE", "filename": filename, "content": contents,},
+                    {
+                        "method": "STORE",
+                        "filename": filename,
+                        "size": size,
+                        "mode": "stream",
+                    },
                 )
 
-                self.success(
-                    f"Successfully transferred {len(contents)} bytes to remote as {filename}"
-                )
+                # the remote may already hold part of an interrupted upload
+                response = await self.recv_json()
 
-            except BrokenPipeError:
+                if response.get("error"):
+                    self.error(f"Failed to store {filename}: {response['error']}")
+                    return
+
+                offset = response["offset"]
+
+                infile.seek(offset)
+                await common.sendfile_body(self.writer, infile, size - offset)
+
+                response = await self.recv_json()
+
+            except (BrokenPipeError, ConnectionResetError):
                 self.require_connection()
+                return
 
-    async def retrieve_string(self, filename):
-        if self.writer is None:
-            self.require_connection()
+        error = response.get("error", None)
+
+        if error:
+            self.error(f"Failed to store {filename}: {error}")
             return
 
-        await self.send_json(
-            {"method": "RETRIEVE", "filename": filename,}
+        self.success(
+            f"Successfully transferred {size - offset} bytes to remote as {filename}"
         )
 
+    def report_transfer(self, size, seconds, success=True):
+        if self.on_transfer is not None and self.hostname is not None:
+            self.on_transfer(self.hostname, size, seconds, success)
+
+    async def receive_stream(self, header, outfile):
+        """
+        Receives the body and trailer of a streamed RETRIEVE into `outfile`
+        and reports how long it took. Returns the number of bytes received.
+        """
+        started = time.monotonic()
+
+        try:
+            size = await common.recv_file_body(self.reader, outfile, header["length"])
+        except IncompleteReadError:
+            self.report_transfer(0, time.monotonic() - started, False)
+            raise
+
+        await self.recv_json()
+
+        self.report_transfer(size, time.monotonic() - started)
+        return size
+
+    async def request_stream(self, filename, offset=0, length=None):
+        """
+        Requests a streamed RETRIEVE of `length` bytes of `filename` starting at
+        `offset` and returns the header frame, or `None` if the remote reported
+        an error. Without a `length` the rest of the file is requested.
+        """
+        request = {"method": "RETRIEVE", "filename": filename, "mode": "stream"}
+
+        if offset:
+            request["offset"] = offset
+        if length is not None:
+            request["length"] = length
+
+        await self.send_json(request)
+
         response = await self.recv_json()
 
+        # the remote is busy sending other files, wait for our turn
+        while response is not None and response.get("queued"):
+            self.info(f"Queued for {filename} at position {response['position']}")
+            response = await self.recv_json()
+
+        if response is None:
+            self.error(f"Connection lost while retrieving {filename}")
+            return
+
         error = response.get("error", None)
 
         if error:
             self.error(f"Failed to retrieve {filename}: {error}")
             return
 
-        contents = response["content"]
+        return response
 
-        return base64.b64decode(contents).decode("utf-8")
+    async def probe(self, filename):
+        """
+        Returns the header of a RETRIEVE of no bytes of `filename`, which
+        tells its current size and version, or `None` on failure.
+        """
+        header = await self.request_stream(filename, 0, 0)
 
-    async def retrieve(self, filename):
+        if header is not None:
+            await self.recv_json()
+
+        return header
+
+    async def retrieve_range(self, filename, offset=0, length=None):
+        """
+        Retrieves a byte range of `filename` into memory and returns it, or
+        `None` on failure.
+        """
+        if self.writer is None:
+            self.require_connection()
+            return
+
+        header = await self.request_stream(filename, offset, length)
+
+        if header is None:
+            return
+
+        contents = io.BytesIO()
+        await self.receive_stream(header, contents)
+
+        return contents.getvalue()
+
+    async def retrieve_string(self, filename):
+        contents = await self.retrieve_range(filename)
+
+        if contents is None:
+            return
+
+        return contents.decode("utf-8")
+
+    async def search(self, keyword, filenames=None):
+        """
+        Asks the remote which of its files contain `keyword` and returns their
+        names. Without `filenames` every shared file is searched.
+        """
+        if self.writer is None:
+            self.require_connection()
+            return
+
+        request = {"method": "SEARCH", "keyword": keyword}
+
+        if filenames is not None:
+            request["files"] = filenames
+
+        await self.send_json(request)
+
+        response = await self.recv_json()
+
+        error = response.get("error", None)
+
+        if error:
+            self.error(f"Failed to search for {keyword}: {error}")
+            return
+
+        return response["files"]
+
+    async def hashes(self, filename, piece_size=common.PIECE_SIZE):
+        """
+        Asks the remote for the size, digest and per-piece digests of a file.
+        """
         if self.writer is None:
             self.require_connection()
             return
 
         await self.send_json(
-            {"method": "RETRIEVE", "filename": filename,}
+            {"method": "HASH", "filename": filename, "piece_size": piece_size,}
         )
 
         response = await self.recv_json()
@@ -202,20 +342,75 @@ class FTPClient:
         error = response.get("error", None)
 
         if error:
-            self.error(f"Failed to retrieve {filename}: {error}")
+            self.error(f"Failed to hash {filename}: {error}")
             return
 
-        contents = response["content"]
+        return response
 
-        with open(filename, "wb") as outfile:
-            # base64 decode from the request body
-            contents = base64.b64decode(contents)
-            outfile.write(contents)
+    async def retrieve(self, filename, resume=True):
+        if self.writer is None:
+            self.require_connection()
+            return
 
-        self.success(
-            f"Successfully transferred {len(contents)} bytes from remote into {filename}"
+        # continue an interrupted download from the end of its partial file,
+        # if the remote file is still the version it was started from
+        offset = 0
+        partial = common.find_download(filename) if resume else None
+
+        if partial is not None:
+            temp_path, size, mtime_ns = partial
+            offset = os.path.getsize(temp_path)
+
+            remote = await self.probe(filename)
+            if remote is None:
+                return
+
+            if (remote["size"], remote.get("mtime_ns")) != (size, mtime_ns) or (
+                offset > size
+            ):
+                # the remote file changed since, the partial file is no use
+                os.remove(temp_path)
+                offset = 0
+
+        header = await self.request_stream(filename, offset)
+
+        if header is None:
+            return
+
+        # remotes that don't tell versions apart can't be resumed from safely
+        resumable = header.get("mtime_ns") is not None
+
+        temp_path = common.download_path(
+            filename, header["size"], header.get("mtime_ns") or 0
         )
 
+        if offset and not os.path.exists(temp_path):
+            # the remote file changed between the probe and the request
+            self.error(f"{filename} changed on the remote, retrieve it again")
+            await self.disconnect()
+            return
+
+        # write each chunk straight to disk as it arrives, and only rename
+        # the file into place once it is complete
+        try:
+            with open(temp_path, "ab" if offset else "wb") as outfile:
+                size = await self.receive_stream(header, outfile)
+        except IncompleteReadError:
+            if not resumable:
+                os.remove(temp_path)
+            raise
+
+        os.replace(temp_path, filename)
+
+        if offset:
+            self.success(
+                f"Resumed {filename} at {offset} bytes, transferred {size} more bytes from remote"
+            )
+        else:
+            self.success(
+                f"Successfully transferred {size} bytes from remote into {filename}"
+            )
+
     async def delete_file(self, filename):
         if self.writer is None:
             self.require_connection()
@@ -249,5 +444,6 @@ class FTPClient:
         self.info("Valid commands are:")
         self.info("\tCONNECT <IP> <PORT>")
         self.info("\tRETRIEVE <FILENAME>")
+        self.info("\tSWARM <FILENAME> [<HOST:PORT> ...]")
         self.info("\tLIST")
         self.info("\tQUIT")
@@ -1,21 +1,116 @@
 import common
-from asyncio import StreamReader, StreamWriter
+from asyncio import StreamReader, StreamWriter, IncompleteReadError
 import asyncio
 import os
 import base64
-from typing import Dict
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_ISREG
+from typing import Dict, List, Set
 
-# filter out files with *.py extensions
+from ftp.directory import DirectoryCache
+from ftp.shaping import TokenBucket, UploadSlots
+from hashing import Hasher
+from watcher import DirectoryWatcher
+
+# filter out files with *.py extensions, unfinished uploads and the hash cache
 def filter_files(path):
     _, extension = os.path.splitext(path[0])
 
-    if extension == ".py":
+    if extension == ".py" or not common.is_shared(path[0]):
         return False
     else:
         return True
 
 
+def read_range(filename: str, offset: int, length=None):
+    with open(filename, "rb") as infile:
+        infile.seek(offset)
+        return infile.read(-1 if length is None else length)
+
+
+def write_atomically(filename: str, contents: bytes):
+    """
+    Writes a whole file next to `filename` and renames it into place, so
+    readers never see a half written file.
+    """
+    fd, temp_path = tempfile.mkstemp(
+        prefix=".", suffix=".part", dir=os.path.dirname(filename) or "."
+    )
+
+    with os.fdopen(fd, "wb") as outfile:
+        outfile.write(contents)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+    os.replace(temp_path, filename)
+
+
+def sync_file(outfile):
+    outfile.flush()
+    os.fsync(outfile.fileno())
+
+
+def search_files(filenames: List[str], needle: bytes):
+    return [
+        f for f in filenames if os.path.isfile(f) and common.file_contains(f, needle)
+    ]
+
+
 class FTPServer:
+    def __init__(
+        self,
+        use_sendfile=True,
+        hasher: Hasher = None,
+        disk_threads=4,
+        upload_rate=None,
+        connection_rate=None,
+        upload_slots=4,
+    ):
+        # serve streamed file bodies with the kernel's sendfile when possible
+        self.use_sendfile = use_sendfile
+
+        # bytes per second sent to all clients together and to each one,
+        # `None` for no limit
+        self.upload_bucket = TokenBucket(upload_rate)
+        self.connection_rate = connection_rate
+
+        # how many files are sent at once, the rest wait their turn
+        self.upload_slots = UploadSlots(upload_slots)
+
+        # hashes files for HASH requests off the event loop, remembering the
+        # hashes of files that didn't change
+        self.hasher = hasher if hasher is not None else Hasher()
+
+        # every blocking file system call runs in these threads, so a slow
+        # disk doesn't hold up the other connections
+        self.disk_pool = ThreadPoolExecutor(disk_threads, thread_name_prefix="disk")
+
+        # the shared directory's files, listed again only when they change
+        self.directory = DirectoryCache()
+
+        # partial files an upload is being received into, so two uploads of
+        # the same file don't append to the same partial file
+        self.receiving: Set[str] = set()
+
+    async def disk(self, function, *args):
+        """
+        Runs a blocking file system call in the disk threads.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.disk_pool, function, *args)
+
+    async def shared_files(self):
+        """
+        Returns the name and stat result of every file offered to clients.
+        """
+        listing = await self.disk(self.directory.listing)
+        return {f: stat for f, stat in listing.items() if filter_files((f,))}
+
+    async def watch_directory(self):
+        async for changed in DirectoryWatcher(self.directory.path).changes():
+            self.directory.invalidate(changed)
+
     async def handle_file_request(
         self, request: Dict, reader: StreamReader, writer: StreamWriter
     ):
@@ -34,7 +129,172 @@ class FTPServer:
 
             common.send_json(writer, {"filename": filename, "content": contents})
 
+    async def stream_file(
+        self,
+        filename: str,
+        writer: StreamWriter,
+        offset: int = 0,
+        length=None,
+        throttle=None,
+    ):
+        """
+        Sends `length` bytes of a file starting at `offset` as a JSON header, the
+        raw file contents in fixed size chunks, and a JSON trailer. Only one
+        chunk is held in memory at a time.
+
+        Without a `length` everything from `offset` to the end of the file is
+        sent. `throttle` limits the rate the contents are sent at.
+        """
+        try:
+            infile = await self.disk(open, filename, "rb")
+        except OSError:
+            await common.send_json(writer, {"error": "file does not exist"})
+            return
+
+        with infile:
+            stat = os.fstat(infile.fileno())
+            size = stat.st_size
+
+            if offset < 0 or offset > size or (length is not None and length < 0):
+                await common.send_json(writer, {"error": "invalid range"})
+                return
+
+            if length is None or offset + length > size:
+                length = size - offset
+
+            await common.send_json(
+                writer,
+                {
+                    "filename": filename,
+                    "size": size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "offset": offset,
+                    "length": length,
+                    "chunk_size": common.CHUNK_SIZE,
+                },
+            )
+
+            infile.seek(offset)
+
+            if self.use_sendfile:
+                sent = await common.sendfile_body(writer, infile, length, throttle)
+            else:
+                sent = await common.send_file_body(
+                    writer, infile, length, self.disk_pool, throttle
+                )
+
+        if sent != length:
+            # the file shrunk underneath us, the client can't recover the
+            # framing so drop the connection
+            print(f"File {filename} was truncated during transfer")
+            writer.close()
+            return
+
+        await common.send_json(writer, {"success": "transfer complete", "size": sent})
+
+    async def send_contents(
+        self, filename: str, writer: StreamWriter, offset=0, length=None, throttle=None
+    ):
+        """
+        Sends a byte range of a file inside a single message, for clients
+        that don't stream.
+        """
+        try:
+            contents = await self.disk(read_range, filename, offset, length)
+        except OSError:
+            await common.send_json(writer, {"error": "file does not exist"})
+            return
+
+        if throttle is not None:
+            await throttle(len(contents))
+
+        # base64 encode the binary file unless the codec carries raw bytes
+        contents = common.encode_binary(writer, contents)
+
+        await common.send_json(writer, {"filename": filename, "content": contents})
+
+    def connection_throttle(self):
+        """
+        Returns a throttle for a new connection, limiting it to its own rate
+        and the server's overall rate.
+        """
+        bucket = TokenBucket(self.connection_rate)
+
+        async def throttle(size: int):
+            await self.upload_bucket.consume(size)
+            await bucket.consume(size)
+
+        return throttle
+
+    async def receive_file(
+        self, request: Dict, reader: StreamReader, writer: StreamWriter
+    ):
+        """
+        Receives a streamed STORE into a partial file next to the target and
+        renames it into place once every byte has arrived. If the connection
+        drops the partial file is kept, and the next STORE of the same file
+        and size resumes from where it stopped.
+
+        Returns `False` if the connection was lost.
+        """
+        filename = request["filename"]
+        size = request.get("size")
+
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            await common.send_json(writer, {"error": "invalid size"})
+            return True
+
+        temp_path = common.partial_path(filename, size)
+
+        if temp_path in self.receiving:
+            await common.send_json(writer, {"error": "upload already in progress"})
+            return True
+
+        self.receiving.add(temp_path)
+        try:
+            return await self.receive_partial(filename, size, temp_path, reader, writer)
+        finally:
+            self.receiving.discard(temp_path)
+
+    async def receive_partial(
+        self,
+        filename: str,
+        size: int,
+        temp_path: str,
+        reader: StreamReader,
+        writer: StreamWriter,
+    ):
+        outfile = await self.disk(open, temp_path, "ab")
+
+        with outfile:
+            offset = outfile.tell()
+
+            if offset > size:
+                await self.disk(outfile.truncate, 0)
+                offset = 0
+
+            # tell the client where to resume from
+            await common.send_json(writer, {"filename": filename, "offset": offset})
+
+            try:
+                await common.recv_file_body(
+                    reader, outfile, size - offset, self.disk_pool
+                )
+            except IncompleteReadError:
+                print(f"Upload of {filename} interrupted at {outfile.tell()} bytes")
+                return False
+
+            await self.disk(sync_file, outfile)
+
+        await self.disk(os.replace, temp_path, filename)
+        self.directory.invalidate([os.path.basename(filename)])
+
+        await common.send_json(writer, {"success": "file stored", "size": size})
+        return True
+
     async def run_forever(self, local_port):
+        asyncio.create_task(self.watch_directory())
+
         server = await asyncio.start_server(
             self.handle_request, "127.0.0.1", local_port
         )
@@ -47,6 +307,11 @@ class FTPServer:
             await server.serve_forever()
 
     async def handle_request(self, reader: StreamReader, writer: StreamWriter):
+        connection = writer
+        common.configure_transport(connection)
+
+        throttle = self.connection_throttle()
+
         while True:
             request = await common.recv_json(reader)
 
@@ -55,49 +320,109 @@ class FTPServer:
             if request is None:
                 break
 
+            # tagged requests are answered in order, with the same tag, so
+            # clients can pipeline several requests on one connection
+            writer = connection
+            if common.is_envelope(request):
+                writer = common.TaggedWriter(connection, request["id"])
+                request = request["body"]
+
             if not request["method"]:
                 print("Invalid Request: missing method field.")
 
-            if request["method"].upper().startswith("LIST"):
-                files = [f for f in os.listdir(".") if os.path.isfile(f)]
-                file_sizes = [
-                    common.sizeof_fmt(os.path.getsize(f))
-                    for f in os.listdir(".")
-                    if os.path.isfile(f)
+            if request["method"].upper().startswith("HELLO"):
+                await common.accept_codec(request, reader, writer)
+
+            elif request["method"].upper().startswith("LIST"):
+                files = [
+                    (f, common.sizeof_fmt(stat.st_size))
+                    for f, stat in (await self.shared_files()).items()
                 ]
 
-                files = list(zip(files, file_sizes))
+                await common.send_json(writer, {"files": files,})
+
+            elif request["method"].upper().startswith("RETRIEVE"):
+                filename = request["filename"]
+
+                offset = request.get("offset", 0)
+                length = request.get("length")
 
-                files = filter(filter_files, files)
+                notify = None
+                if request.get("mode") == "stream":
+                    # streaming clients are told where they are in the queue
+                    notify = lambda position: common.send_json(
+                        writer, {"queued": True, "position": position}
+                    )
 
-                files = list(files)
+                await self.upload_slots.acquire(notify)
 
-                await common.send_json(writer, {"files": files,})
+                try:
+                    if request.get("mode") == "stream":
+                        await self.stream_file(
+                            filename, writer, offset, length, throttle
+                        )
+                    else:
+                        await self.send_contents(
+                            filename, writer, offset, length, throttle
+                        )
+                finally:
+                    self.upload_slots.release()
 
-            elif request["method"].upper().startswith("RETRIEVE"):
+            elif request["method"].upper().startswith("SEARCH"):
+                needle = request["keyword"].encode("utf-8")
+                filenames = request.get("files")
+
+                if filenames is None:
+                    filenames = list(await self.shared_files())
+
+                matches = await self.disk(search_files, filenames, needle)
+
+                await common.send_json(writer, {"files": matches})
+
+            elif request["method"].upper().startswith("HASH"):
                 filename = request["filename"]
 
-                if not os.path.exists(filename):
+                try:
+                    stat = await self.disk(os.stat, filename)
+                except OSError:
+                    stat = None
+
+                if stat is None or not S_ISREG(stat.st_mode):
                     await common.send_json(writer, {"error": "file does not exist"})
-                    return
+                    continue
 
-                with open(filename, "rb") as infile:
-                    contents = infile.read()
+                piece_size = request.get("piece_size", common.PIECE_SIZE)
 
-                    # base64 encode the binary file
-                    contents = base64.b64encode(contents).decode("utf-8")
+                size = stat.st_size
+                digest, pieces = await self.hasher.hash(filename, piece_size)
 
-                    await common.send_json(
-                        writer, {"filename": filename, "content": contents}
-                    )
+                if piece_size == common.PIECE_SIZE:
+                    await self.hasher.save(self.disk_pool)
+
+                await common.send_json(
+                    writer,
+                    {
+                        "filename": filename,
+                        "size": size,
+                        "sha256": digest,
+                        "piece_size": piece_size,
+                        "pieces": pieces,
+                    },
+                )
 
             elif request["method"].upper().startswith("STORE"):
                 filename = request["filename"]
 
-                with open(filename, "wb") as outfile:
-                    # base64 decode from the request body
-                    contents = base64.b64decode(request["content"])
-                    outfile.write(contents)
+                if request.get("mode") == "stream":
+                    if not await self.receive_file(request, reader, writer):
+                        break
+                    continue
+
+                # base64 decode from the request body
+                contents = common.decode_binary(request["content"])
+
+                await self.disk(write_atomically, filename, contents)
+                self.directory.invalidate([os.path.basename(filename)])
 
                 # threaded_print("-> Store Complete")
 
@@ -109,14 +434,16 @@ class FTPServer:
 
                 filename = request["filename"]
 
-                if not os.path.exists(filename):
+                try:
+                    await self.disk(os.remove, filename)
+                except OSError:
                     await common.send_json(writer, {"error": "file does not exist"})
                 else:
-                    os.remove(filename)
+                    self.directory.invalidate([os.path.basename(filename)])
                     await common.send_json(writer, {"success": "file removed"})
 
             else:
                 await common.send_json(writer, {"error": "Unsupported command"})
 
-        writer.close()
-        await writer.wait_closed()
+        connection.close()
+        await connection.wait_closed()
@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+from contextlib import asynccontextmanager
+from typing import Dict, List, Tuple
+
+from ftp.ftp_client import FTPClient
+
+
+class FTPConnectionPool:
+    """
+    Keeps connections to peer file servers open between requests.
+
+    Connections are keyed by the peer's "host:port". At most `max_per_peer`
+    connections to a single peer are in use at once, idle connections are
+    closed after `idle_timeout` seconds, and connections are checked before
+    being handed out again.
+    """
+
+    def __init__(self, max_per_peer=4, idle_timeout=30.0):
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+
+        # idle connections by hostname, with the time they were returned
+        self.idle: Dict[str, List[Tuple[FTPClient, float]]] = {}
+        self.slots: Dict[str, asyncio.Semaphore] = {}
+
+        # connections currently open, idle or in use
+        self.open = 0
+
+    def slot(self, hostname: str):
+        if hostname not in self.slots:
+            self.slots[hostname] = asyncio.Semaphore(self.max_per_peer)
+        return self.slots[hostname]
+
+    @asynccontextmanager
+    async def connection(self, hostname: str):
+        """
+        Yields a connected `FTPClient` for `hostname`, or `None` if the peer
+        can't be reached. A connection is only reused if the block finishes
+        without an exception or cancellation.
+        """
+        async with self.slot(hostname):
+            client = await self.acquire(hostname)
+
+            if client is None:
+                yield None
+                return
+
+            try:
+                yield client
+            except BaseException:
+                # the connection may be halfway through a response
+                await self.close(client)
+                raise
+
+            self.idle.setdefault(hostname, []).append((client, time.monotonic()))
+
+    async def acquire(self, hostname: str):
+        connections = self.idle.get(hostname, [])
+
+        while connections:
+            client, returned = connections.pop()
+
+            if time.monotonic() - returned < self.idle_timeout and healthy(client):
+                return client
+
+            await self.close(client)
+
+        address, port = hostname.split(":")
+
+        client = FTPClient()
+        await client.connect(address, port)
+
+        if client.writer is None:
+            return None
+
+        self.open += 1
+        return client
+
+    async def close(self, client: FTPClient):
+        self.open -= 1
+        try:
+            await client.disconnect()
+        except OSError:
+            pass
+
+    async def close_peer(self, hostname: str):
+        """
+        Closes the idle connections to a peer, for example when it left.
+        """
+        for client, _ in self.idle.pop(hostname, []):
+            await self.close(client)
+
+    async def expire_forever(self, interval=10.0):
+        """
+        Periodically closes connections that have been idle for too long.
+        """
+        while True:
+            await asyncio.sleep(interval)
+
+            now = time.monotonic()
+            stale = []
+
+            for hostname, connections in list(self.idle.items()):
+                fresh = []
+                for client, returned in connections:
+                    if now - returned < self.idle_timeout and healthy(client):
+                        fresh.append((client, returned))
+                    else:
+                        stale.append(client)
+
+                if fresh:
+                    self.idle[hostname] = fresh
+                else:
+                    del self.idle[hostname]
+
+            for client in stale:
+                await self.close(client)
+
+
+def healthy(client: FTPClient):
+    """
+    Returns whether an idle connection can still be used. A peer that closed
+    its side leaves the reader at EOF.
+    """
+    return (
+        client.writer is not None
+        and not client.writer.is_closing()
+        and not client.reader.at_eof()
+    )
@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+from collections import deque
+from typing import Deque, Optional
+
+
+class TokenBucket:
+    """
+    Limits a byte stream to `rate` bytes per second on average, allowing
+    bursts of up to `burst` bytes, by default a tenth of a second's worth. A
+    `rate` of `None` doesn't limit at all.
+
+    Consumers that take more than is available go into debt and wait until
+    it is paid back, so concurrent consumers share the rate.
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else (rate or 0) / 10
+
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, size: int) -> float:
+        """
+        Takes `size` tokens if they are available without going into debt.
+        Returns 0 if they were taken, or else the seconds until they will be.
+        """
+        if not self.rate:
+            return 0
+
+        self.refill()
+
+        if self.tokens < size:
+            return (size - self.tokens) / self.rate
+
+        self.tokens -= size
+        return 0
+
+    async def consume(self, size: int):
+        if not self.rate:
+            return
+
+        self.refill()
+
+        self.tokens -= size
+
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class UploadSlots:
+    """
+    Limits how many files are sent at once. Requests beyond `count` wait in
+    a FIFO queue and can be told their position as it changes.
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+        self.active = 0
+
+        self.waiting: Deque[asyncio.Future] = deque()
+
+        # resolved and replaced whenever the queue moves
+        self.moved: Optional[asyncio.Future] = None
+
+    def position(self, waiter: asyncio.Future):
+        return self.waiting.index(waiter) + 1
+
+    async def acquire(self, notify=None):
+        """
+        Waits for a free slot. While queued `notify` is awaited with the
+        1-based queue position whenever it changes.
+        """
+        if self.active < self.count and not self.waiting:
+            self.active += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiting.append(waiter)
+
+        try:
+            reported = None
+
+            while not waiter.done():
+                position = self.position(waiter)
+                if notify is not None and position != reported:
+                    reported = position
+                    await notify(position)
+
+                if waiter.done():
+                    break
+
+                await asyncio.wait(
+                    [waiter, self.queue_moved()],
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # granted a slot we can no longer use
+                self.release()
+            else:
+                waiter.cancel()
+                self.waiting.remove(waiter)
+                self.signal()
+            raise
+
+    def release(self):
+        self.active -= 1
+
+        while self.waiting and self.active < self.count:
+            waiter = self.waiting.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.active += 1
+
+        self.signal()
+
+    def queue_moved(self):
+        if self.moved is None or self.moved.done():
+            self.moved = asyncio.get_running_loop().create_future()
+        return self.moved
+
+    def signal(self):
+        if self.moved is not None and not self.moved.done():
+            self.moved.set_result(None)
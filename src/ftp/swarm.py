@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import os
+from collections import Counter
+from typing import List
+
+import common
+from ftp.ftp_client import FTPClient
+
+
+class SwarmDownload:
+    """
+    Downloads a single file from several peers at once.
+
+    The file is split into pieces that every source races to fetch, so faster
+    peers end up serving more of the file. Each piece is checked against the
+    piece digests published by the sources before it is written, and a piece
+    that fails the check is fetched again from a different peer. The file is
+    assembled in a partial file and only renamed into place once complete.
+
+    Reading, hashing and writing pieces runs in worker threads, so the GUI
+    stays responsive.
+    """
+
+    def __init__(
+        self, filename: str, sources: List[str], output=None, on_transfer=None
+    ):
+        self.filename = filename
+        self.sources = sources
+        self.output = output
+
+        # told about every piece downloaded, see `FTPClient.on_transfer`
+        self.on_transfer = on_transfer
+
+        # used only to report progress to the output widget
+        self.console = FTPClient(output)
+
+        # the FTPClient of every source that is still usable, by hostname
+        self.clients = {}
+
+        self.size = 0
+        self.piece_size = common.PIECE_SIZE
+        self.pieces = []
+        self.remaining = set()
+
+        # the number of sources that agreed on the file contents
+        self.peers = 0
+
+    async def run(self):
+        """
+        Runs the download and returns `True` if the complete file was written.
+        """
+        try:
+            if not await self.fetch_manifest():
+                return False
+
+            self.peers = len(self.clients)
+            temp_path = common.swarm_path(self.filename, self.size)
+
+            fd = os.open(temp_path, os.O_RDWR | os.O_CREAT)
+
+            with os.fdopen(fd, "r+b") as outfile:
+                self.remaining -= await self.disk(self.check_existing, outfile)
+
+                # keep going while there is work left and someone to do it
+                while self.remaining and self.clients:
+                    queue = asyncio.Queue()
+                    for index in sorted(self.remaining):
+                        queue.put_nowait(index)
+
+                    await asyncio.gather(
+                        *[
+                            self.worker(hostname, queue, outfile)
+                            for hostname in list(self.clients)
+                        ]
+                    )
+
+                if self.remaining:
+                    self.console.error(
+                        f"Swarm download of {self.filename} stopped with "
+                        f"{len(self.remaining)} pieces missing"
+                    )
+                    return False
+
+                await self.disk(os.fsync, outfile.fileno())
+
+            os.replace(temp_path, self.filename)
+            self.console.success(
+                f"Downloaded {self.filename} ({common.sizeof_fmt(self.size)}) "
+                f"from {self.peers} sources"
+            )
+            return True
+
+        finally:
+            for client in self.clients.values():
+                await client.disconnect()
+
+    async def fetch_manifest(self):
+        """
+        Connects to every source and asks it for the piece digests of the
+        file. Sources that disagree with the majority hold a different file
+        and are dropped.
+        """
+        manifests = {}
+
+        for hostname in self.sources:
+            address, port = hostname.split(":")
+            client = FTPClient(self.output)
+            client.on_transfer = self.on_transfer
+
+            await client.connect(address, port)
+            if client.writer is None:
+                if self.on_transfer is not None:
+                    self.on_transfer(hostname, 0, 0.0, False)
+                continue
+
+            try:
+                response = await client.hashes(self.filename, self.piece_size)
+            except Exception as e:
+                self.console.error(f"Source {hostname} failed: {e}")
+                response = None
+
+            if response is None:
+                await client.disconnect()
+                continue
+
+            manifests[hostname] = (response["size"], tuple(response["pieces"]))
+            self.clients[hostname] = client
+
+        if not manifests:
+            self.console.error(f"No source could provide {self.filename}")
+            return False
+
+        (self.size, pieces), _ = Counter(manifests.values()).most_common(1)[0]
+        self.pieces = list(pieces)
+        self.remaining = set(range(len(self.pieces)))
+
+        for hostname, manifest in manifests.items():
+            if manifest != (self.size, pieces):
+                self.console.error(
+                    f"Source {hostname} holds a different {self.filename}"
+                )
+                await self.drop(hostname)
+
+        return True
+
+    async def disk(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, function, *args)
+
+    def check_existing(self, outfile):
+        """
+        Sizes the partial file and returns the pieces left over from an
+        earlier, interrupted download that already match their digest.
+        """
+        outfile.truncate(self.size)
+
+        done = set()
+
+        for index in range(len(self.pieces)):
+            data = os.pread(
+                outfile.fileno(), self.piece_length(index), index * self.piece_size
+            )
+
+            if hashlib.sha256(data).hexdigest() == self.pieces[index]:
+                done.add(index)
+
+        return done
+
+    def write_piece(self, outfile, index, data):
+        """
+        Writes a piece if it matches its digest and returns whether it did.
+        Pieces are written at their offset without seeking, so several can
+        be written at once.
+        """
+        if hashlib.sha256(data).hexdigest() != self.pieces[index]:
+            return False
+
+        os.pwrite(outfile.fileno(), data, index * self.piece_size)
+        return True
+
+    def piece_length(self, index):
+        return min(self.piece_size, self.size - index * self.piece_size)
+
+    async def drop(self, hostname):
+        client = self.clients.pop(hostname, None)
+        if client is not None:
+            await client.disconnect()
+
+    async def worker(self, hostname, queue: asyncio.Queue, outfile):
+        client = self.clients[hostname]
+
+        while not queue.empty():
+            index = queue.get_nowait()
+            offset = index * self.piece_size
+
+            try:
+                data = await client.retrieve_range(
+                    self.filename, offset, self.piece_length(index)
+                )
+            except Exception as e:
+                data = None
+                self.console.error(f"Source {hostname} failed: {e}")
+
+            if data is None:
+                # hand the piece to the remaining sources
+                queue.put_nowait(index)
+                await self.drop(hostname)
+                return
+
+            if not await self.disk(self.write_piece, outfile, index, data):
+                # this peer serves corrupt data, don't trust it again
+                self.console.error(f"Piece {index} from {hostname} failed verification")
+                client.report_transfer(0, 0.0, False)
+                queue.put_nowait(index)
+                await self.drop(hostname)
+                return
+
+            self.remaining.discard(index)
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import os
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import common
+
+
+def hash_file(path: str, piece_size: int = common.PIECE_SIZE):
+    """
+    Returns the sha256 hex digest of a file and of each of its pieces. Runs in
+    the worker processes of a `Hasher`.
+    """
+    with open(path, "rb") as infile:
+        return common.hash_pieces(infile, piece_size)
+
+
+class HashCache:
+    """
+    The content hashes of the shared files, persisted in a sidecar file so
+    they survive restarts.
+
+    Entries are keyed by filename and are only valid as long as the file's
+    size and mtime stay the same.
+    """
+
+    def __init__(self, path: str = common.HASH_CACHE):
+        self.path = path
+        self.entries: Dict[str, Dict] = {}
+
+        # whether entries changed since the last save
+        self.dirty = False
+
+        try:
+            with open(path) as infile:
+                self.entries = json.load(infile).get("files", {})
+        except (OSError, ValueError):
+            pass
+
+    def get(self, filename: str, size: int, mtime: float):
+        entry = self.entries.get(filename)
+
+        if (
+            entry is None
+            or entry["size"] != size
+            or entry["mtime"] != mtime
+            or entry["piece_size"] != common.PIECE_SIZE
+        ):
+            return None
+
+        return entry["sha256"], entry["pieces"]
+
+    def put(self, filename: str, size: int, mtime: float, digest: str, pieces):
+        self.entries[filename] = {
+            "size": size,
+            "mtime": mtime,
+            "sha256": digest,
+            "piece_size": common.PIECE_SIZE,
+            "pieces": pieces,
+        }
+        self.dirty = True
+
+    def prune(self, keep: Iterable[str]):
+        """
+        Drops the entries of files that are no longer shared.
+        """
+        keep = set(keep)
+
+        for filename in list(self.entries):
+            if filename not in keep:
+                del self.entries[filename]
+                self.dirty = True
+
+    def snapshot(self) -> Optional[Dict[str, Dict]]:
+        """
+        Returns a copy of the entries for `write`, or `None` if nothing
+        changed since the last save. Entries are replaced rather than changed
+        in place, so a shallow copy is safe to write while `put` goes on.
+        """
+        if not self.dirty:
+            return None
+
+        self.dirty = False
+        return dict(self.entries)
+
+    def write(self, entries: Dict[str, Dict]):
+        """
+        Writes a `snapshot` of the entries. This blocks on the file system
+        and may run in a worker thread.
+        """
+        # write a new file and swap it in, so a crash can't leave a torn cache
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+
+        try:
+            with os.fdopen(fd, "w") as outfile:
+                json.dump({"files": entries}, outfile)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Failed to save the hash cache: {e}")
+            os.unlink(temp_path)
+
+            # try again with the next save
+            self.dirty = True
+
+    def save(self):
+        entries = self.snapshot()
+        if entries is not None:
+            self.write(entries)
+
+
+class Hasher:
+    """
+    Hashes shared files in a pool of worker processes, so large files are
+    hashed in parallel and without blocking the event loop. Hashes of files
+    that didn't change are taken from the `HashCache`.
+    """
+
+    def __init__(self, cache: Optional[HashCache] = None, workers=None):
+        self.cache = cache if cache is not None else HashCache()
+        self.workers = workers
+        self.executor = None
+
+    def pool(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+        return self.executor
+
+    def cached(self, filename: str) -> Optional[Tuple[str, List[str]]]:
+        """
+        Returns the cached hashes of a file, or `None` if it was never hashed
+        or changed since.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+
+        return self.cache.get(filename, stat.st_size, stat.st_mtime)
+
+    async def hash(self, filename: str, piece_size: int = common.PIECE_SIZE):
+        """
+        Returns the sha256 digest of a file and of each of its pieces.
+        """
+        loop = asyncio.get_event_loop()
+
+        if piece_size != common.PIECE_SIZE:
+            # only the usual piece size is cached
+            return await loop.run_in_executor(
+                self.pool(), hash_file, filename, piece_size
+            )
+
+        stat = os.stat(filename)
+
+        cached = self.cache.get(filename, stat.st_size, stat.st_mtime)
+        if cached is not None:
+            return cached
+
+        digest, pieces = await loop.run_in_executor(self.pool(), hash_file, filename)
+
+        # a file written to while it was hashed is hashed again next time
+        after = os.stat(filename)
+        if (after.st_size, after.st_mtime) == (stat.st_size, stat.st_mtime):
+            self.cache.put(filename, stat.st_size, stat.st_mtime, digest, pieces)
+
+        return digest, pieces
+
+    async def hash_files(self, filenames: List[str]):
+        """
+        Hashes the files that aren't cached yet and saves the cache. Files
+        that can't be read are skipped.
+        """
+        results = await asyncio.gather(
+            *[self.hash(f) for f in filenames], return_exceptions=True
+        )
+
+        await self.save()
+
+        return {
+            f: result
+            for f, result in zip(filenames, results)
+            if not isinstance(result, BaseException)
+        }
+
+    async def save(self, executor=None):
+        """
+        Saves the cache without blocking the event loop, writing it in
+        `executor` or else in the default thread pool.
+        """
+        entries = self.cache.snapshot()
+
+        if entries is not None:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(executor, self.cache.write, entries)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
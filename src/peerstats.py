@@ -0,0 +1,157 @@
+import time
+
+from typing import Optional
+
+# bytes per second a peer is assumed to send at until transfers from it have
+# been measured, from the speed it reports about itself
+NOMINAL_RATES = {
+    "dial-up": 56_000 / 8,
+    "dsl": 10_000_000 / 8,
+    "gigabit": 1_000_000_000 / 8,
+}
+
+DEFAULT_RATE = NOMINAL_RATES["dsl"]
+
+# round trip time assumed before the first heartbeat
+DEFAULT_RTT = 0.1
+
+# weight of a new measurement in the moving averages
+SMOOTHING = 0.3
+
+# transfers smaller than this say more about latency than throughput
+MIN_THROUGHPUT_SAMPLE = 64 * 1024
+
+# consecutive failures that open a peer's circuit breaker
+BREAKER_THRESHOLD = 3
+
+# seconds an open breaker waits before letting a request through, doubled
+# every time the trial fails, up to the maximum
+BREAKER_COOLDOWN = 15.0
+MAX_BREAKER_COOLDOWN = 300.0
+
+# factor the expected download time from a peer with an open breaker is
+# multiplied by, so its files are listed last
+OPEN_BREAKER_PENALTY = 100
+
+
+def smooth(average: Optional[float], sample: float):
+    if average is None:
+        return sample
+    return average + SMOOTHING * (sample - average)
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a peer that keeps failing.
+
+    It is only fed by requests the server makes itself, so a client can't cut
+    a peer off by reporting failures about it.
+
+    After `BREAKER_THRESHOLD` consecutive failures the breaker opens and
+    `allow` refuses requests, so a dead peer doesn't add a timeout to every
+    search. Once the cooldown passed a single trial request is let through,
+    which closes the breaker again if it succeeds.
+    """
+
+    __slots__ = ("failures", "opened_at", "cooldown", "trial")
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.cooldown = BREAKER_COOLDOWN
+
+        # when the trial request of a half open breaker was let through. A
+        # trial that never reported back is given up on after the cooldown.
+        self.trial: Optional[float] = None
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+
+        now = time.monotonic()
+        if now - (self.trial or self.opened_at) < self.cooldown:
+            return False
+
+        self.trial = now
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.cooldown = BREAKER_COOLDOWN
+        self.trial = None
+
+    def failure(self):
+        self.failures += 1
+
+        if self.trial is not None:
+            # the peer is still failing, wait longer before the next trial
+            self.trial = None
+            self.cooldown = min(self.cooldown * 2, MAX_BREAKER_COOLDOWN)
+            self.opened_at = time.monotonic()
+        elif self.opened_at is None and self.failures >= BREAKER_THRESHOLD:
+            self.opened_at = time.monotonic()
+
+
+class PeerStats:
+    """
+    What we measured about a peer: the round trip time of its heartbeats,
+    and the throughput and outcome of the downloads clients made from it.
+    """
+
+    __slots__ = (
+        "rtt",
+        "throughput",
+        "reliability",
+        "transfers",
+        "failures",
+        "breaker",
+    )
+
+    def __init__(self):
+        self.rtt: Optional[float] = None
+        self.throughput: Optional[float] = None
+
+        # moving average of transfers that succeeded, from 0 to 1
+        self.reliability = 1.0
+
+        self.transfers = 0
+        self.failures = 0
+
+        self.breaker = CircuitBreaker()
+
+    def observe_rtt(self, seconds: float):
+        self.rtt = smooth(self.rtt, seconds)
+
+    def observe_transfer(self, size: int, seconds: float, success: bool):
+        self.transfers += 1
+        self.reliability = smooth(self.reliability, 1.0 if success else 0.0)
+
+        # clients only report transfers, which can't be verified, so they
+        # shape the estimate but never trip the breaker
+        if not success:
+            self.failures += 1
+            return
+
+        if size >= MIN_THROUGHPUT_SAMPLE and seconds > 0:
+            self.throughput = smooth(self.throughput, size / seconds)
+
+    def expected_time(self, size: Optional[int], nominal_rate: float):
+        """
+        Returns the seconds a download of `size` bytes from the peer is
+        expected to take. Unreliable peers are expected to take longer, since
+        the download may have to be retried elsewhere.
+        """
+        rtt = self.rtt if self.rtt is not None else DEFAULT_RTT
+        rate = self.throughput if self.throughput is not None else nominal_rate
+
+        expected = (rtt + (size or 0) / rate) / max(self.reliability, 0.1)
+
+        if self.breaker.open:
+            expected *= OPEN_BREAKER_PENALTY
+
+        return expected
@@ -1,113 +1,505 @@
 #!/bin/python
 
 # import socket programming library
+import argparse
 import base64
 import json
 import os
+import re
 import socket
 import struct
+import sys
 import threading
+import time
 import common
 import asyncio
+import heapq
 
-from ftp.ftp_client import FTPClient
-from common import Event
+from ftp.pool import FTPConnectionPool
+from admission import Admission
+from common import ConnectionSpeed, Event
+from cache import LRUCache
+from catalog import Catalog, FileRecord, Peer
+from peerstats import DEFAULT_RATE, NOMINAL_RATES, PeerStats
+from trigrams import TrigramIndex, decode_trigrams, trigrams
 from asyncio import StreamReader, StreamWriter
 
-from typing import Dict
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
+from itertools import chain
+from operator import itemgetter
+from typing import Dict, List, Set, Tuple
 
-VALID_METHODS = ["CONNECT", "LIST"]
+VALID_METHODS = [
+    "HELLO",
+    "CONNECT",
+    "LIST",
+    "KEYWORD",
+    "INDEX",
+    "FIND",
+    "ADD",
+    "UPDATE",
+    "REMOVE",
+    "HASHES",
+    "HEARTBEAT",
+    "REPORT",
+]
 
+# methods that go through admission control, with how expensive they are.
+# Cheaper ones are let through first when requests queue up.
+EXPENSIVE_METHODS = {"FIND": 0, "KEYWORD": 1}
 
-class Client:
-    username: str = ""
-    hostname: str = ""
-    speed: str = ""
-    files: {} = {}
+FIND_MODES = ["substring", "prefix", "glob", "fuzzy"]
 
-    def __init__(self, username: str, hostname: str, speed: str, files: Dict):
-        self.username = username
-        self.hostname = hostname
-        self.speed = speed
-        self.files = files
+# lowest similarity a fuzzy FIND result may have
+MIN_FUZZY_SCORE = 0.1
+
+# filenames are indexed between these, so prefixes and suffixes have
+# trigrams of their own
+NAME_START = b"\x02"
+NAME_END = b"\x03"
+
+# wildcards and character classes of a glob pattern
+GLOB_SPECIAL = re.compile(r"\*|\?|\[[^\]]*\]")
+
+
+# any of these fields turns a LIST into a paginated one
+PAGED_LIST_FIELDS = {"page_size", "cursor", "pattern", "speed", "sort", "stream"}
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 5000
+
+SPEED_RANKS = {speed.value: rank for rank, speed in enumerate(ConnectionSpeed)}
+
+# sort keys for paginated LIST, all ending in the username so every file has a
+# distinct key to continue from. "fastest" sorts by expected download time,
+# see `Server.sort_key`.
+SORT_KEYS = {
+    "filename": lambda c, f: (f.filename, c.hostname, c.username),
+    "hostname": lambda c, f: (c.hostname, f.filename, c.username),
+    "speed": lambda c, f: (
+        SPEED_RANKS.get(c.speed, len(SPEED_RANKS)),
+        f.filename,
+        c.hostname,
+        c.username,
+    ),
+}
+
+
+SORTS = [*SORT_KEYS, "fastest"]
+
+# the types of the parts of each sort key, to check the cursors clients send
+CURSOR_TYPES = {
+    "filename": (str, str, str),
+    "hostname": (str, str, str),
+    "speed": (int, str, str, str),
+    "fastest": ((int, float), str, str, str),
+}
+
+# estimates that change by less than this factor don't reorder listings
+RERANK_FACTOR = 1.25
+
+# bytes a search cache entry takes besides the strings in its key: the key and
+# value tuples, the file's size and mtime, and the cache's own dict entry and
+# group set entry
+SEARCH_CACHE_ENTRY_OVERHEAD = 340
+
+# the stats of peers nothing was measured about yet
+UNMEASURED = PeerStats()
+
+
+def file_entry(client: Peer, file: FileRecord):
+    """
+    Returns the description of a file sent in LIST and KEYWORD responses.
+    """
+    return {
+        "filename": file.filename,
+        "hostname": client.hostname,
+        "speed": client.speed,
+    }
+
+
+def name_trigrams(filename: str):
+    return trigrams(NAME_START + filename.lower().encode("utf-8") + NAME_END)
+
+
+def glob_trigrams(pattern: str):
+    """
+    Returns the trigrams every filename matching the lowercase glob `pattern`
+    contains, taken from the literal text between its wildcards.
+    """
+    literal = GLOB_SPECIAL.sub("\0", pattern).encode("utf-8")
+    literal = NAME_START + literal + NAME_END
+
+    found = set()
+    for run in literal.split(b"\0"):
+        found |= trigrams(run)
+
+    return found
+
+
+def valid_cursor(sort: str, cursor):
+    """
+    Returns whether `cursor` is a cursor of `sort` as sent with a page: the
+    sort followed by the key of the last file on the page.
+    """
+    types = CURSOR_TYPES[sort.lstrip("-")]
+
+    if not isinstance(cursor, list) or len(cursor) != len(types) + 1:
+        return False
+
+    if cursor[0] != sort:
+        return False
+
+    return all(
+        isinstance(part, kind) and not isinstance(part, bool)
+        for part, kind in zip(cursor[1:], types)
+    )
+
+
+def search_cache_key(client: Peer, file: FileRecord, keyword: str):
+    """
+    Returns the search cache key of a file, or `None` if its peer didn't
+    report a version for it and the answer can't be cached safely.
+    """
+    if file.size is None or file.mtime is None:
+        return None
+
+    return (client.hostname, file.filename, file.size, file.mtime, keyword)
+
+
+def search_cache_size(key):
+    """
+    Returns roughly how many bytes a search cache entry under `key` takes.
+    """
+    return SEARCH_CACHE_ENTRY_OVERHEAD + sum(
+        sys.getsizeof(part) for part in key if isinstance(part, str)
+    )
 
 
 class Server:
+    def __init__(
+        self,
+        search_concurrency=8,
+        peer_timeout=5.0,
+        search_cache_bytes=16 * 1024 * 1024,
+        peer_connections=4,
+        retain_seconds=60.0,
+        stale_after=60.0,
+        search_budget=4,
+        search_queue=32,
+        client_search_rate=5.0,
+        client_search_burst=10,
+    ):
+        # every connected peer and its files
+        self.catalog = Catalog()
 
-    clients: [] = []
-    files: [] = []
+        # how many peers a KEYWORD search contacts at once
+        self.search_concurrency = search_concurrency
+        self.search_slots = None
 
-    def __init__(self):
-        pass
+        # seconds to wait for a single peer to answer a search
+        self.peer_timeout = peer_timeout
+
+        # trigrams of the file contents peers published, keyed by
+        # (username, filename)
+        self.content_index = TrigramIndex()
+
+        # files peers sent without trigrams, keyed by (username, filename).
+        # A KEYWORD search can't rule these out and asks their peer.
+        self.unindexed: Set[Tuple[str, str]] = set()
+
+        # trigrams of every filename and file description in the catalog,
+        # keyed by (username, filename)
+        self.name_index = TrigramIndex()
+        self.description_index = TrigramIndex()
+
+        # whether a file contains a keyword, as answered by its peer. Keys
+        # include the file's size and mtime so changed files miss the cache.
+        self.search_cache = LRUCache(search_cache_bytes)
+
+        # bumped whenever a peer joins, leaves or changes its files
+        self.generation = 0
+
+        # each peer's LIST entries, encoded once per codec, by username. An
+        # entry is stale once its generation differs from the peer's.
+        self.list_fragments: Dict[str, Tuple[int, Dict[str, bytes]]] = {}
+
+        # each peer's files sorted by each sort key, by username and sort.
+        # Paginated listings merge these runs, so a change only resorts the
+        # files of the peer it happened to. A run is stale once the peer's
+        # generation differs, or for "fastest" also once `stats_version` does.
+        self.list_runs: Dict[str, Dict[str, Tuple[Tuple, List, List]]] = {}
+
+        # measured round trip times and transfer rates by peer hostname, and
+        # a counter bumped whenever an estimate changed enough to reorder
+        # results
+        self.stats: Dict[str, PeerStats] = {}
+        self.stats_version = 0
+
+        # peers that left recently, with the handle that drops their catalog
+        # once `retain_seconds` pass, by username
+        self.retain_seconds = retain_seconds
+        self.departed: Dict[str, Tuple[Peer, asyncio.TimerHandle]] = {}
+
+        # the control connection of every connected peer, so peers that stop
+        # sending heartbeats for `stale_after` seconds can be evicted
+        self.stale_after = stale_after
+        self.connections: Dict[Peer, StreamWriter] = {}
+
+        # connections to the peers' file servers, reused across searches
+        self.pool = FTPConnectionPool(max_per_peer=peer_connections)
+
+        # limits how many searches run at once and how often each client may
+        # search, so searching clients can't starve everyone else
+        self.admission = Admission(
+            budget=search_budget,
+            max_queued=search_queue,
+            client_rate=client_search_rate,
+            client_burst=client_search_burst,
+        )
 
     def run(self):
         asyncio.run(self.serve())
 
+    async def dispatch(
+        self, method: str, request, client, reader: StreamReader, writer: StreamWriter
+    ) -> Peer:
+        """
+        Handles a request, passing expensive ones through admission control
+        first. Requests that can't be admitted are answered with an error and
+        the seconds after which a retry may succeed.
+        """
+        cost = EXPENSIVE_METHODS.get(method)
+
+        if cost is None or client is None:
+            return await self.handle_request(method, request, client, reader, writer)
+
+        retry_after = self.admission.reject(client.username)
+
+        if retry_after is not None:
+            print(f"Rejected {method} from {client.hostname}: server busy")
+            await common.send_json(
+                writer, {"error": "server busy", "retry_after": round(retry_after, 3)}
+            )
+            return
+
+        async with self.admission.slot(client.username, cost):
+            return await self.handle_request(method, request, client, reader, writer)
+
     async def handle_request(
         self, method: str, request, client, reader: StreamReader, writer: StreamWriter
-    ) -> Client:
+    ) -> Peer:
+
+        if method == "HELLO":
+            await common.accept_codec(request, reader, writer)
 
-        if method == "CONNECT":
+        elif method == "CONNECT":
             username = request["username"]
             hostname = request["hostname"]
             speed = request["speed"]
-            files = request["files"]
+            files = request.get("files")
+
+            # the catalog the peer had before it left, or before its old
+            # connection dropped if we haven't noticed yet
+            retained = self.reclaim(username)
+            previous = retained or self.catalog.get(username)
+
+            if files is None:
+                # the peer only sent the digest of its catalog, which is
+                # enough if we still have the same one
+                digest = request.get("digest")
+
+                if previous is None or digest != self.digest(previous):
+                    if retained is not None:
+                        self.forget_files(retained)
+
+                    await common.send_json(writer, {"files_required": True})
+                    return
+
+                print(f"Restored catalog of client with hostname: {hostname}")
+                client = Peer(username, hostname, speed, [])
+                client.files = previous.files
+
+                self.catalog.add(client)
+                self.touch(client)
+
+                await common.send_json(
+                    writer, {"success": "connection successful", "restored": True}
+                )
+                return client
+
+            if retained is not None:
+                self.forget_files(retained)
 
             print(f"Accepted new client with hostname: {hostname}")
-            client = Client(username, hostname, speed, files)
-            self.clients.append(client)
+            client = Peer(username, hostname, speed, [])
+
+            replaced = self.catalog.add(client)
+            if replaced is not None:
+                self.forget_files(replaced)
+
+            self.set_files(client, files)
             await common.send_json(writer, {"success": "connection successful"})
             return client
 
+        elif method == "HEARTBEAT":
+            # peers measure the round trip of their heartbeats and send the
+            # last one along with the next
+            rtt = request.get("rtt")
+            if client is not None and rtt is not None:
+                self.observe(client.hostname, lambda stats: stats.observe_rtt(rtt))
+
+            if client is not None:
+                client.last_seen = time.monotonic()
+
+            await common.send_json(writer, {"success": "alive"})
+
+        elif method == "REPORT":
+            # the outcome of a download a client made from a peer, sent in
+            # the background so no response is sent
+            hostname = request["hostname"]
+            size = request.get("size", 0)
+            seconds = request.get("seconds", 0)
+            success = request.get("success", True)
+
+            # only keep stats about peers we know
+            if any(c.hostname == hostname for c in self.catalog):
+                self.observe(
+                    hostname,
+                    lambda stats: stats.observe_transfer(size, seconds, success),
+                )
+
+        elif method == "LIST" and request.get("group"):
+            await common.send_json(writer, {"groups": self.list_groups(client)})
+
+        elif method == "LIST" and PAGED_LIST_FIELDS & request.keys():
+            await self.send_list_pages(client, request, writer)
+
         elif method == "LIST":
-            files = []
+            chosen = common.get_codec(writer)
 
-            for c in self.clients:
-                if c.username != client.username:
-                    for file in c.files:
-                        files.append(
-                            {
-                                "filename": file["filename"],
-                                "hostname": c.hostname,
-                                "speed": c.speed,
-                            }
-                        )
+            # peers that are expected to send files fastest come first
+            peers = sorted(
+                self.catalog.others(client.username),
+                key=lambda c: self.expected_time(c, common.PIECE_SIZE),
+            )
+
+            # splice the cached, already encoded files of every other peer
+            # into one array instead of encoding the whole list again
+            count = sum(len(c.files) for c in peers)
+            payload = chosen.join_items(
+                [self.list_fragment(c, chosen) for c in peers], count
+            )
 
-            print(files)
+            print(f"Sent {count} files")
 
-            await common.send_json(writer, files)
+            await common.send_encoded(writer, payload)
 
         elif method == "KEYWORD":
             keyword = request["keyword"]
+            needle = keyword.encode("utf-8")
 
-            files_to_search = []
-
-            for c in self.clients:
-                if c.username != client.username:
-                    for file in c.files:
-                        files_to_search.append(
-                            {
-                                "filename": file["filename"],
-                                "hostname": c.hostname,
-                                "speed": c.speed,
-                            }
-                        )
+            # (client, file) pairs that matched, and those whose peer has to
+            # be asked
+            matches = []
+            unsearched = []
 
-            files = []
+            # the content index rules out files missing any trigram of the
+            # keyword. The rest are only candidates and are confirmed by
+            # their peer, or by its cached answer, along with the files that
+            # weren't indexed.
+            if len(needle) >= 3:
+                candidates = chain(self.content_index.query(needle), self.unindexed)
+                found = self.resolve(client, candidates)
+            else:
+                # too short to have trigrams, every file is a candidate
+                found = (
+                    (c, f)
+                    for c in self.catalog.others(client.username)
+                    for f in c.files.values()
+                )
+
+            for c, file in found:
+                cached = self.search_cache.get(search_cache_key(c, file, keyword))
+                if cached is None:
+                    unsearched.append((c, file))
+                elif cached:
+                    matches.append((c, file))
+
+            # group the files by the peer holding them, so each peer is
+            # asked once and only sends back the names that matched
+            peers = {}
+            for c, file in unsearched:
+                peers.setdefault(c.hostname, []).append((c, file))
+
+            failed = []
+
+            # peers that kept failing aren't asked until their breaker lets a
+            # trial through, so they don't add a timeout to every search
+            for hostname in list(peers):
+                if not self.peer_stats(hostname).breaker.allow():
+                    del peers[hostname]
+                    failed.append(hostname)
+
+            # the fastest peers are first in line for a search slot
+            order = sorted(
+                peers,
+                key=lambda h: self.expected_time(peers[h][0][0], common.PIECE_SIZE),
+            )
+            peers = {hostname: peers[hostname] for hostname in order}
+
+            results = await asyncio.gather(
+                *[
+                    self.search_peer(hostname, keyword, peer_files)
+                    for hostname, peer_files in peers.items()
+                ]
+            )
+
+            for hostname, found in zip(peers, results):
+                if found is None:
+                    failed.append(hostname)
+                else:
+                    matches.extend(found)
+
+            matches.sort(key=lambda m: self.expected_time(*m))
+            files = [file_entry(c, file) for c, file in matches]
+
+            await common.send_json(writer, {"files": files, "failed": failed})
+
+        elif method == "FIND":
+            await self.find_files(client, request, writer)
 
-            # get each file
-            for file in files_to_search:
-                hostname = file["hostname"]
-                address, port = hostname.split(":")
+        elif method == "INDEX":
+            # the peer's files changed, replace its catalog and index. Peers
+            # send this in the background so no response is sent.
+            self.forget_files(client)
+            self.set_files(client, request["files"])
 
-                ftpclient = FTPClient()
+        elif method in ("ADD", "UPDATE"):
+            # files were added to or changed in the peer's shared directory,
+            # sent in the background like INDEX
+            for file in request["files"]:
+                self.unindex_file(client, file["filename"])
+                self.index_file(client, file)
+            self.touch(client)
 
-                await ftpclient.connect(address, port)
-                contents = await ftpclient.retrieve_string(file["filename"])
-                if keyword in contents:
-                    files.append(file)
+        elif method == "REMOVE":
+            for filename in request["filenames"]:
+                self.unindex_file(client, filename)
+            self.touch(client)
 
-            await common.send_json(writer, files)
+        elif method == "HASHES":
+            # content hashes of files the peer sent before it hashed them.
+            # Files that changed since are sent again in an UPDATE instead.
+            for entry in request["files"]:
+                file = client.files.get(entry["filename"])
+                if file is not None and (file.size, file.mtime) == (
+                    entry.get("size"),
+                    entry.get("mtime"),
+                ):
+                    file.sha256 = entry["sha256"]
+            self.touch(client)
 
         else:
             # invalid method
@@ -118,7 +510,553 @@ class Server:
                 },
             )
 
+    def set_files(self, client: Peer, files: List[Dict]):
+        """
+        Stores the files a peer sent in the catalog and indexes them.
+        """
+        client.files = {}
+
+        for file in files:
+            self.index_file(client, file)
+
+        self.touch(client)
+
+    def forget_files(self, client: Peer):
+        """
+        Drops everything derived from a peer's files, before they are replaced
+        or the peer leaves.
+        """
+        for filename in list(client.files):
+            self.unindex_file(client, filename)
+
+        self.search_cache.discard_group(client.hostname)
+
+        self.generation += 1
+        self.list_fragments.pop(client.username, None)
+        self.list_runs.pop(client.username, None)
+
+    def index_file(self, client: Peer, file: Dict):
+        """
+        Adds a single file to a peer's catalog and to the indexes. Its
+        trigrams go into the content index, files sent without trigrams are
+        searched by the peer instead.
+        """
+        key = (client.username, file["filename"])
+
+        encoded = file.get("trigrams")
+        if encoded is not None:
+            self.content_index.add(key, decode_trigrams(encoded))
+        else:
+            self.unindexed.add(key)
+
+        self.name_index.add(key, name_trigrams(file["filename"]))
+
+        description = file.get("description")
+        if description:
+            found = trigrams(description.lower().encode("utf-8"))
+            self.description_index.add(key, found)
+
+        client.files[file["filename"]] = FileRecord.from_dict(file)
+
+    def unindex_file(self, client: Peer, filename: str):
+        """
+        Removes a single file from a peer's catalog and from the indexes.
+        """
+        key = (client.username, filename)
+
+        self.content_index.remove(key)
+        self.unindexed.discard(key)
+        self.name_index.remove(key)
+        self.description_index.remove(key)
+
+        client.files.pop(filename, None)
+
+    async def retain(self, client: Peer):
+        """
+        Keeps the catalog of a peer that left for `retain_seconds`, so it can
+        be restored if the peer reconnects with the same files. Until then
+        its files are indexed but not listed or searched.
+        """
+        self.generation += 1
+
+        if self.retain_seconds <= 0:
+            self.forget_files(client)
+            self.stats.pop(client.hostname, None)
+            self.admission.forget(client.username)
+            await self.pool.close_peer(client.hostname)
+            return
+
+        loop = asyncio.get_event_loop()
+        expiry = loop.call_later(self.retain_seconds, self.expire, client)
+        self.departed[client.username] = (client, expiry)
+
+    def reclaim(self, username: str):
+        """
+        Returns the retained peer that left with `username`, if any, and
+        stops it from expiring.
+        """
+        retained = self.departed.pop(username, None)
+        if retained is None:
+            return None
+
+        client, expiry = retained
+        expiry.cancel()
+        return client
+
+    def expire(self, client: Peer):
+        if self.departed.get(client.username, (None,))[0] is not client:
+            return
+
+        del self.departed[client.username]
+        print(f"Dropped catalog of client with hostname: {client.hostname}")
+
+        self.forget_files(client)
+        self.stats.pop(client.hostname, None)
+        self.admission.forget(client.username)
+        asyncio.create_task(self.pool.close_peer(client.hostname))
+
+    def digest(self, client: Peer):
+        return common.catalog_digest(
+            (f.filename, f.size, f.mtime, f.description)
+            for f in client.files.values()
+        )
+
+    def touch(self, client: Peer):
+        """
+        Marks a peer's files as changed, so listings built from them are
+        rebuilt.
+        """
+        self.generation += 1
+        client.generation = self.generation
+
+    async def find_files(self, client: Peer, request, writer: StreamWriter):
+        """
+        Answers a FIND, a search of the other peers' filenames and, for
+        substring searches, their file descriptions.
+        """
+        query = request.get("query", "")
+        mode = request.get("mode", "substring")
+        limit = request.get("limit", DEFAULT_PAGE_SIZE)
+
+        if not isinstance(mode, str) or mode not in FIND_MODES:
+            await common.send_json(
+                writer,
+                {"error": f"invalid mode '{mode}', expected one of {FIND_MODES}"},
+            )
+            return
+
+        if not isinstance(query, str):
+            await common.send_json(writer, {"error": "invalid query"})
+            return
+
+        if not isinstance(limit, int) or isinstance(limit, bool):
+            limit = 0
+
+        if limit < 1:
+            await common.send_json(writer, {"error": "invalid limit"})
+            return
+
+        query = query.lower()
+        limit = min(limit, MAX_PAGE_SIZE)
+
+        if mode == "fuzzy":
+            scored = self.find_similar(client, query)
+            scored.sort(key=lambda m: (-m[0], self.expected_time(m[1], m[2])))
+
+            files = []
+            for score, c, file in scored[:limit]:
+                entry = file_entry(c, file)
+                entry["score"] = round(score, 3)
+                files.append(entry)
+
+            await common.send_json(writer, {"files": files})
+            return
+
+        needle = query.encode("utf-8")
+
+        if mode == "substring":
+            wanted = trigrams(needle)
+            matches = lambda f: query in f.filename.lower() or (
+                f.description is not None and query in f.description.lower()
+            )
+        elif mode == "prefix":
+            wanted = trigrams(NAME_START + needle)
+            matches = lambda f: f.filename.lower().startswith(query)
+        else:
+            wanted = glob_trigrams(query)
+            matches = lambda f: fnmatchcase(f.filename.lower(), query)
+
+        if wanted:
+            # verify the candidates of the index, which can include names
+            # with the same trigrams in a different order
+            candidates = self.name_index.query_all(wanted)
+            if mode == "substring":
+                candidates |= self.description_index.query_all(wanted)
+
+            found = self.resolve(client, candidates)
+        else:
+            # too short to have trigrams, every file is a candidate
+            found = (
+                (c, f)
+                for c in self.catalog.others(client.username)
+                for f in c.files.values()
+            )
+
+        found = sorted(
+            ((c, f) for c, f in found if matches(f)),
+            key=lambda m: (self.expected_time(*m), m[1].filename),
+        )
+
+        files = [file_entry(c, file) for c, file in found[:limit]]
+
+        await common.send_json(writer, {"files": files})
+
+    def find_similar(self, client: Peer, query: str):
+        """
+        Returns `(score, client, file)` for every filename resembling `query`,
+        scored by how many trigrams they share.
+        """
+        scores = self.name_index.similar(name_trigrams(query))
+        candidates = {key for key, score in scores.items() if score >= MIN_FUZZY_SCORE}
+
+        return [
+            (scores[(c.username, f.filename)], c, f)
+            for c, f in self.resolve(client, candidates)
+        ]
+
+    def resolve(self, client: Peer, keys):
+        """
+        Returns the `(client, file)` pairs of the `(username, filename)` keys
+        in `keys`, leaving out the requesting client's own files.
+        """
+        for username, filename in keys:
+            if username == client.username:
+                continue
+
+            c = self.catalog.get(username)
+            file = c.files.get(filename) if c is not None else None
+
+            if file is not None:
+                yield c, file
+
+    def list_groups(self, client: Peer):
+        """
+        Returns the other peers' files grouped by their contents, so copies
+        of the same file are listed once with every peer holding them.
+        Files that weren't hashed yet are in a group of their own.
+        """
+        groups = {}
+
+        for c in self.catalog.others(client.username):
+            for file in c.files.values():
+                key = file.sha256 or (c.username, file.filename)
+                groups.setdefault(key, []).append((c, file))
+
+        result = []
+
+        for copies in groups.values():
+            # the fastest source of every file first
+            copies.sort(key=lambda m: self.expected_time(*m))
+            _, first = copies[0]
+
+            result.append(
+                {
+                    "sha256": first.sha256,
+                    "size": first.size,
+                    "files": [file_entry(c, file) for c, file in copies],
+                }
+            )
+
+        return sorted(result, key=lambda g: g["files"][0]["filename"])
+
+    def list_run(self, client: Peer, sort: str):
+        """
+        Returns the keys and `(key, peer, file)` entries of a peer's files
+        sorted by `sort`, sorting only if the peer's files changed since, or
+        for "fastest" also if the peers' measurements did.
+        """
+        runs = self.list_runs.setdefault(client.username, {})
+        cached = runs.get(sort)
+
+        version = (client.generation,)
+        if sort == "fastest":
+            version += (self.stats_version,)
+
+        if cached is None or cached[0] != version:
+            key = self.sort_key(sort)
+            entries = sorted(
+                ((key(client, f), client, f) for f in client.files.values()),
+                key=itemgetter(0),
+            )
+            cached = (version, [e[0] for e in entries], entries)
+            runs[sort] = cached
+
+        return cached[1], cached[2]
+
+    def sort_key(self, sort: str):
+        if sort != "fastest":
+            return SORT_KEYS[sort]
+
+        return lambda c, f: (
+            round(self.expected_time(c, f), 6),
+            f.filename,
+            c.hostname,
+            c.username,
+        )
+
+    def expected_time(self, client: Peer, file):
+        """
+        Returns the seconds a download of `file` from a peer is expected to
+        take, from what was measured about the peer or else from the speed it
+        claims. `file` is a `FileRecord` or a size in bytes.
+        """
+        size = file.size if isinstance(file, FileRecord) else file
+        nominal = NOMINAL_RATES.get(client.speed, DEFAULT_RATE)
+
+        stats = self.stats.get(client.hostname, UNMEASURED)
+        return stats.expected_time(size, nominal)
+
+    def peer_stats(self, hostname: str):
+        stats = self.stats.get(hostname)
+        if stats is None:
+            stats = self.stats[hostname] = PeerStats()
+        return stats
+
+    def observe(self, hostname: str, measure):
+        """
+        Records a measurement of a peer with `measure`, and bumps
+        `stats_version` if it changes the peer's ranking noticeably.
+        """
+        stats = self.peer_stats(hostname)
+
+        before = stats.expected_time(common.PIECE_SIZE, DEFAULT_RATE)
+        measure(stats)
+        after = stats.expected_time(common.PIECE_SIZE, DEFAULT_RATE)
+
+        if max(before, after) > min(before, after) * RERANK_FACTOR:
+            self.stats_version += 1
+
+    def list_page(self, client: Peer, request, cursor):
+        """
+        Returns one page of a paginated LIST that starts after `cursor`,
+        together with the cursor of the next page, or `None` if this is the
+        last one.
+        """
+        sort = request.get("sort", "filename")
+        descending = sort.startswith("-")
+        sort = sort.lstrip("-")
+
+        page_size = min(request.get("page_size", DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE)
+
+        pattern = request.get("pattern")
+        if pattern is not None:
+            pattern = pattern.lower()
+
+        speeds = request.get("speed")
+        if isinstance(speeds, str):
+            speeds = [speeds]
+
+        runs = []
+
+        for c in self.catalog.others(client.username):
+            if speeds is not None and c.speed not in speeds:
+                continue
+
+            keys, entries = self.list_run(c, sort)
+
+            # continue right after the last file of the previous page
+            if descending:
+                i = len(keys) - 1 if cursor is None else bisect_left(keys, cursor) - 1
+                positions = range(i, -1, -1)
+            else:
+                i = 0 if cursor is None else bisect_right(keys, cursor)
+                positions = range(i, len(entries))
+
+            runs.append(map(entries.__getitem__, positions))
+
+        page = []
+        last = None
+
+        # only as much of each run as ends up on the page is looked at
+        for key, c, file in heapq.merge(*runs, key=itemgetter(0), reverse=descending):
+            if len(page) == page_size:
+                return page, last
+
+            if pattern is not None and not fnmatchcase(file.filename.lower(), pattern):
+                continue
+
+            page.append(file_entry(c, file))
+            last = key
+
+        return page, None
+
+    async def send_list_pages(self, client: Peer, request, writer: StreamWriter):
+        """
+        Answers a paginated LIST with a single page, or with every page as
+        its own frame when `stream` is set.
+        """
+        sort = request.get("sort", "filename")
+
+        if not isinstance(sort, str) or sort.lstrip("-") not in SORTS:
+            await common.send_json(
+                writer, {"error": f"invalid sort '{sort}', expected one of {SORTS}"},
+            )
+            return
+
+        page_size = request.get("page_size", DEFAULT_PAGE_SIZE)
+
+        if not isinstance(page_size, int) or isinstance(page_size, bool):
+            page_size = 0
+
+        if page_size < 1:
+            await common.send_json(writer, {"error": "invalid page size"})
+            return
+
+        pattern = request.get("pattern")
+        speeds = request.get("speed")
+
+        if isinstance(speeds, str):
+            speeds = [speeds]
+
+        valid_pattern = pattern is None or isinstance(pattern, str)
+        valid_speeds = speeds is None or (
+            isinstance(speeds, list) and all(isinstance(s, str) for s in speeds)
+        )
+
+        if not valid_pattern or not valid_speeds:
+            await common.send_json(writer, {"error": "invalid filter"})
+            return
+
+        # cursors are the sort they belong to followed by the last key sent
+        cursor = request.get("cursor")
+        if cursor is not None:
+            if not valid_cursor(sort, cursor):
+                await common.send_json(writer, {"error": "invalid cursor"})
+                return
+            cursor = tuple(cursor[1:])
+
+        while True:
+            page, cursor = self.list_page(client, request, cursor)
+            done = cursor is None or not request.get("stream")
+
+            await common.send_json(
+                writer,
+                {
+                    "files": page,
+                    "cursor": None if cursor is None else [sort, *cursor],
+                    "done": done,
+                },
+            )
+
+            if done:
+                break
+
+    def list_fragment(self, client: Peer, chosen):
+        """
+        Returns a peer's LIST entries encoded with the codec `chosen`,
+        encoding them only if they changed since the last LIST.
+        """
+        cached = self.list_fragments.get(client.username)
+
+        if cached is None or cached[0] != client.generation:
+            cached = (client.generation, {})
+            self.list_fragments[client.username] = cached
+
+        fragments = cached[1]
+
+        if chosen.name not in fragments:
+            fragments[chosen.name] = chosen.encode_items(
+                file_entry(client, file) for file in client.files.values()
+            )
+
+        return fragments[chosen.name]
+
+    async def search_peer(self, hostname: str, keyword: str, peer_files):
+        """
+        Asks a single peer which of the `(client, file)` pairs in `peer_files`
+        contain `keyword`.
+
+        At most `search_concurrency` peers are searched at once, and a peer
+        that doesn't answer within `peer_timeout` seconds is given up on.
+        Returns the matching pairs, or `None` if the peer failed. The outcome
+        is recorded in the peer's circuit breaker.
+        """
+        found = None
+
+        async with self.search_slots:
+            try:
+                found = await asyncio.wait_for(
+                    self.search_peer_files(hostname, keyword, peer_files),
+                    self.peer_timeout,
+                )
+            except asyncio.TimeoutError:
+                print(f"Search of {hostname} timed out")
+            except Exception as e:
+                print(f"Search of {hostname} failed: {e}")
+
+        if found is None:
+            self.observe(hostname, lambda stats: stats.breaker.failure())
+        else:
+            self.observe(hostname, lambda stats: stats.breaker.success())
+
+        return found
+
+    async def search_peer_files(self, hostname: str, keyword: str, peer_files):
+        async with self.pool.connection(hostname) as ftpclient:
+            if ftpclient is None:
+                return
+
+            matches = await ftpclient.search(
+                keyword, [file.filename for _, file in peer_files]
+            )
+
+        if matches is None:
+            return
+
+        matches = set(matches)
+
+        # remember the answer for every file that reported its version
+        for c, file in peer_files:
+            key = search_cache_key(c, file, keyword)
+            if key is not None:
+                matched = file.filename in matches
+                self.search_cache.put(key, matched, search_cache_size(key), c.hostname)
+
+        return [(c, f) for c, f in peer_files if f.filename in matches]
+
+    async def evict_stale_forever(self):
+        """
+        Disconnects peers that sent heartbeats before but haven't sent
+        anything for `stale_after` seconds. Their catalog is retained like
+        that of any peer that left, in case they come back.
+        """
+        while True:
+            await asyncio.sleep(self.stale_after / 4)
+
+            now = time.monotonic()
+
+            for client in list(self.catalog):
+                if client.last_seen is None:
+                    continue
+                if now - client.last_seen < self.stale_after:
+                    continue
+
+                print(f"Evicting stale client with hostname: {client.hostname}")
+
+                if self.catalog.remove(client):
+                    await self.retain(client)
+
+                writer = self.connections.pop(client, None)
+                if writer is not None:
+                    writer.close()
+
     async def serve(self):
+        self.search_slots = asyncio.Semaphore(self.search_concurrency)
+        asyncio.create_task(self.pool.expire_forever())
+
+        if self.stale_after > 0:
+            asyncio.create_task(self.evict_stale_forever())
+
         server = await asyncio.start_server(self.handle_connect, "127.0.0.1", 12345)
 
         addr = server.sockets[0].getsockname()
@@ -128,36 +1066,79 @@ class Server:
             await server.serve_forever()
 
     async def handle_connect(self, reader: StreamReader, writer: StreamWriter):
+        common.configure_transport(writer)
 
         client = None
 
-        while True:
-            request = await common.recv_json(reader)
+        # requests sent in an id envelope run concurrently, so a slow
+        # KEYWORD doesn't hold up a LIST sent after it
+        tasks = set()
 
-            if request is None:
-                print(f"Client has disconnected: {client.hostname}")
-                self.clients.remove(client)
-                break
+        try:
+            while True:
+                request = await common.recv_json(reader)
 
-            if client is None:
-                print("-> Received Request:")
-            else:
-                print(f"-> Received Request from {client.hostname}:")
+                if request is None:
+                    break
 
-            print(json.dumps(request, indent=4, sort_keys=False))
+                reply_to = writer
+                if common.is_envelope(request):
+                    reply_to = common.TaggedWriter(writer, request["id"])
+                    request = request["body"]
 
-            if not request["method"]:
-                print("Invalid Request: missing method field.")
-                await common.send_json(
-                    writer, {"error": "invalid request: missing method field"}
-                )
-            else:
-                etc = await self.handle_request(
-                    request["method"], request, client, reader, writer
-                )
+                if client is None:
+                    print("-> Received Request:")
+                else:
+                    print(f"-> Received Request from {client.hostname}:")
+
+                    if client.last_seen is not None:
+                        client.last_seen = time.monotonic()
+
+                print(json.dumps(request, indent=4, sort_keys=False, default=repr))
+
+                if not request.get("method"):
+                    print("Invalid Request: missing method field.")
+                    await common.send_json(
+                        reply_to, {"error": "invalid request: missing method field"}
+                    )
+                elif reply_to is not writer and request["method"] != "CONNECT":
+                    task = asyncio.create_task(
+                        self.handle_tagged_request(
+                            request["method"], request, client, reader, reply_to
+                        )
+                    )
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    etc = await self.dispatch(
+                        request["method"], request, client, reader, reply_to
+                    )
+
+                    if etc is not None:
+                        client = etc
+                        self.connections[client] = writer
+        finally:
+            # runs however the connection ended, so the peer never lingers
+            for task in tasks:
+                task.cancel()
+
+            writer.close()
+
+            if client is not None:
+                print(f"Client has disconnected: {client.hostname}")
+                if self.connections.get(client) is writer:
+                    del self.connections[client]
+                if self.catalog.remove(client):
+                    await self.retain(client)
 
-                if etc is not None:
-                    client = etc
+    async def handle_tagged_request(
+        self, method: str, request, client, reader: StreamReader, writer
+    ):
+        try:
+            await self.dispatch(method, request, client, reader, writer)
+        except Exception as e:
+            print(f"Request {method} failed: {e}")
+            await common.send_json(writer, {"error": f"request failed: {e}"})
 
 
 def filter_files(path):
@@ -169,10 +1150,108 @@ def filter_files(path):
         return True
 
 
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--search-concurrency",
+        metavar="PEERS",
+        type=int,
+        help="number of peers a keyword search contacts at once",
+        default=8,
+    )
+    parser.add_argument(
+        "--peer-connections",
+        metavar="CONNECTIONS",
+        type=int,
+        help="maximum open connections to a single peer",
+        default=4,
+    )
+    parser.add_argument(
+        "--search-cache",
+        metavar="MIB",
+        type=int,
+        help="memory budget of the keyword search cache",
+        default=16,
+    )
+    parser.add_argument(
+        "--max-frame",
+        metavar="MIB",
+        type=int,
+        help="largest message accepted from a client",
+        default=64,
+    )
+    parser.add_argument(
+        "--retain-catalog",
+        metavar="SECONDS",
+        type=float,
+        help="time to keep the catalog of a disconnected client for a reconnect",
+        default=60.0,
+    )
+    parser.add_argument(
+        "--peer-timeout",
+        metavar="SECONDS",
+        type=float,
+        help="time to wait for a peer to answer a keyword search",
+        default=5.0,
+    )
+    parser.add_argument(
+        "--stale-after",
+        metavar="SECONDS",
+        type=float,
+        help="time without heartbeats after which a client is disconnected, "
+        "0 to never disconnect",
+        default=60.0,
+    )
+    parser.add_argument(
+        "--search-budget",
+        metavar="SEARCHES",
+        type=int,
+        help="number of keyword and filename searches that run at once",
+        default=4,
+    )
+    parser.add_argument(
+        "--search-queue",
+        metavar="SEARCHES",
+        type=int,
+        help="number of searches that may wait for the budget before more are "
+        "rejected",
+        default=32,
+    )
+    parser.add_argument(
+        "--search-rate",
+        metavar="SEARCHES",
+        type=float,
+        help="searches per second a single client may start on average",
+        default=5.0,
+    )
+    parser.add_argument(
+        "--search-burst",
+        metavar="SEARCHES",
+        type=int,
+        help="searches a single client may start at once",
+        default=10,
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
+
+    common.MAX_FRAME_SIZE = args.max_frame * 1024 * 1024
 
     try:
-        Server().run()
+        Server(
+            search_concurrency=args.search_concurrency,
+            peer_timeout=args.peer_timeout,
+            search_cache_bytes=args.search_cache * 1024 * 1024,
+            peer_connections=args.peer_connections,
+            retain_seconds=args.retain_catalog,
+            stale_after=args.stale_after,
+            search_budget=args.search_budget,
+            search_queue=args.search_queue,
+            client_search_rate=args.search_rate,
+            client_search_burst=args.search_burst,
+        ).run()
     except KeyboardInterrupt:
         print()
         pass
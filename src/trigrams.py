@@ -0,0 +1,141 @@
+import base64
+
+from typing import Dict, Hashable, Iterable, Set
+
+import common
+
+# files with more distinct trigrams than this (usually binary files) are not
+# indexed and have to be searched by their peer instead
+MAX_TRIGRAMS = 32 * 1024
+
+
+def trigrams(data: bytes) -> Set[int]:
+    """
+    Returns every distinct run of three bytes in `data`, packed into an int.
+    """
+    return {
+        (data[i] << 16) | (data[i + 1] << 8) | data[i + 2] for i in range(len(data) - 2)
+    }
+
+
+def file_trigrams(path: str, limit: int = MAX_TRIGRAMS):
+    """
+    Reads a file one chunk at a time and returns its trigrams, or `None` if it
+    has more than `limit` distinct trigrams.
+    """
+    found = set()
+    tail = b""
+
+    with open(path, "rb") as infile:
+        while True:
+            chunk = infile.read(common.CHUNK_SIZE)
+            if not chunk:
+                break
+
+            # keep the last two bytes so trigrams spanning chunks are found
+            data = tail + chunk
+            found |= trigrams(data)
+            tail = data[-2:]
+
+            if len(found) > limit:
+                return None
+
+    return found
+
+
+def encode_trigrams(found: Iterable[int], binary=False):
+    """
+    Packs a trigram set into three bytes per trigram. Unless `binary` is set
+    the result is base64 encoded so it can be sent inside a JSON message.
+    """
+    packed = b"".join(t.to_bytes(3, "big") for t in sorted(found))
+
+    if binary:
+        return packed
+
+    return base64.b64encode(packed).decode("utf-8")
+
+
+def decode_trigrams(encoded) -> Set[int]:
+    packed = common.decode_binary(encoded)
+    return {int.from_bytes(packed[i : i + 3], "big") for i in range(0, len(packed), 3)}
+
+
+class TrigramIndex:
+    """
+    An inverted index from trigrams to the documents containing them.
+
+    A query returns every document containing all the trigrams of the search
+    string. That is a superset of the documents containing the string itself,
+    but false positives need the same trigrams out of order and are rare for
+    real keywords.
+    """
+
+    def __init__(self):
+        self.postings: Dict[int, Set[Hashable]] = {}
+        self.documents: Dict[Hashable, Set[int]] = {}
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __contains__(self, key):
+        return key in self.documents
+
+    def add(self, key: Hashable, found: Set[int]):
+        self.remove(key)
+        self.documents[key] = found
+
+        for trigram in found:
+            self.postings.setdefault(trigram, set()).add(key)
+
+    def remove(self, key: Hashable):
+        found = self.documents.pop(key, None)
+        if found is None:
+            return
+
+        for trigram in found:
+            keys = self.postings[trigram]
+            keys.discard(key)
+            if not keys:
+                del self.postings[trigram]
+
+    def query(self, needle: bytes) -> Set[Hashable]:
+        """
+        Returns the documents that may contain `needle`. The needle must be at
+        least three bytes long.
+        """
+        return self.query_all(trigrams(needle))
+
+    def query_all(self, wanted: Set[int]) -> Set[Hashable]:
+        """
+        Returns the documents containing every trigram in `wanted`.
+        """
+        # intersect the shortest posting lists first
+        postings = sorted((self.postings.get(t, set()) for t in wanted), key=len)
+
+        if not postings:
+            return set()
+
+        result = set(postings[0])
+        for keys in postings[1:]:
+            result &= keys
+            if not result:
+                break
+
+        return result
+
+    def similar(self, wanted: Set[int]) -> Dict[Hashable, float]:
+        """
+        Returns every document sharing a trigram with `wanted`, scored by the
+        Jaccard similarity of their trigram sets.
+        """
+        shared: Dict[Hashable, int] = {}
+
+        for trigram in wanted:
+            for key in self.postings.get(trigram, ()):
+                shared[key] = shared.get(key, 0) + 1
+
+        return {
+            key: count / (len(wanted) + len(self.documents[key]) - count)
+            for key, count in shared.items()
+        }
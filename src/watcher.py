@@ -0,0 +1,171 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+
+from typing import Optional, Set
+
+# inotify(7) events that change what a directory shares
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCHED_EVENTS = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+)
+
+# wd, mask, cookie, name length
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def load_inotify():
+    """
+    Returns libc if it provides inotify, otherwise `None`.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError, TypeError):
+        return None
+
+    return libc
+
+
+libc = load_inotify()
+
+
+class DirectoryWatcher:
+    """
+    Reports which files in a directory changed.
+
+    Uses inotify where the platform has it, and otherwise lists the directory
+    every `interval` seconds. Changes arriving within `delay` seconds of each
+    other are reported together, so a file being written reports once.
+    """
+
+    def __init__(self, path=".", interval=10.0, delay=0.5):
+        self.path = path
+        self.interval = interval
+        self.delay = delay
+
+        # the inotify descriptor once watching started, see `start`
+        self.fd: Optional[int] = None
+
+    def start(self):
+        """
+        Starts watching before `changes` is iterated, so changes made in the
+        meantime are reported by its first iterations.
+        """
+        if self.fd is None:
+            self.fd = self.open_inotify()
+
+    async def changes(self, rescan=False):
+        """
+        Yields sets of the names that changed. `None` means anything could
+        have changed and the whole directory has to be checked again, which
+        is what's yielded first if `rescan` is set.
+        """
+        self.start()
+        fd, self.fd = self.fd, None
+
+        loop = asyncio.get_event_loop()
+        events = asyncio.Queue()
+
+        if fd is not None:
+            loop.add_reader(fd, lambda: events.put_nowait(read_events(fd)))
+
+        try:
+            if rescan:
+                yield None
+
+            if fd is None:
+                while True:
+                    await asyncio.sleep(self.interval)
+                    yield None
+
+            while True:
+                changed = await events.get()
+
+                # gather everything else that happens shortly after
+                await asyncio.sleep(self.delay)
+                while not events.empty():
+                    more = events.get_nowait()
+                    if changed is None or more is None:
+                        changed = None
+                    else:
+                        changed |= more
+
+                if changed is None or changed:
+                    yield changed
+        finally:
+            if fd is not None:
+                loop.remove_reader(fd)
+                os.close(fd)
+
+    def close(self):
+        """
+        Stops watching if `start` was called but `changes` never iterated.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def open_inotify(self) -> Optional[int]:
+        if libc is None:
+            return None
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+
+        path = os.fsencode(os.path.abspath(self.path))
+        if libc.inotify_add_watch(fd, path, WATCHED_EVENTS) < 0:
+            os.close(fd)
+            return None
+
+        return fd
+
+
+def read_events(fd: int) -> Optional[Set[str]]:
+    """
+    Reads the pending inotify events and returns the names they concern, or
+    `None` if the kernel dropped events.
+    """
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return set()
+
+    names = set()
+    offset = 0
+
+    while offset < len(data):
+        _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+
+        if mask & IN_Q_OVERFLOW:
+            return None
+
+        name = data[offset : offset + length].rstrip(b"\0")
+        offset += length
+
+        if name:
+            names.add(os.fsdecode(name))
+
+    return names
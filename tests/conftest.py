@@ -0,0 +1,37 @@
+import json
+import os
+import struct
+import sys
+
+# the sources import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+class FrameWriter:
+    """
+    Collects the JSON frames a handler sends.
+    """
+
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def frames(self):
+        frames = []
+        data = self.data
+
+        while data:
+            (size,) = struct.unpack(">I", data[:4])
+            frames.append(json.loads(data[4 : 4 + size]))
+            data = data[4 + size :]
+
+        return frames
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from admission import DEFAULT_SERVICE_TIME, Admission
+
+
+async def hold(admission, client, cost, order, release=None):
+    async with admission.slot(client, cost):
+        order.append((client, cost))
+        if release is not None:
+            await release.wait()
+
+
+def test_queued_requests_run_cheapest_and_least_busy_first():
+    async def run():
+        admission = Admission(budget=1)
+        order = []
+        release = asyncio.Event()
+
+        holder = asyncio.create_task(hold(admission, "holder", 0, order, release))
+        await asyncio.sleep(0)
+
+        queued = [
+            asyncio.create_task(hold(admission, client, cost, order))
+            for client, cost in [("a", 1), ("b", 0), ("a", 0), ("c", 0)]
+        ]
+        await asyncio.sleep(0)
+
+        release.set()
+        await asyncio.gather(holder, *queued)
+
+        assert admission.active == 0
+        assert not admission.queue
+        assert not admission.in_flight
+        return order
+
+    # cheaper first, then clients with fewer requests in flight, then in
+    # arrival order
+    assert asyncio.run(run()) == [
+        ("holder", 0),
+        ("b", 0),
+        ("c", 0),
+        ("a", 0),
+        ("a", 1),
+    ]
+
+
+def test_full_queue_rejects_with_retry_after():
+    async def run():
+        admission = Admission(budget=1, max_queued=1)
+        order = []
+        release = asyncio.Event()
+
+        assert admission.reject("a") is None
+
+        holder = asyncio.create_task(hold(admission, "a", 0, order, release))
+        queued = asyncio.create_task(hold(admission, "b", 0, order))
+        await asyncio.sleep(0)
+
+        retry_after = admission.reject("c")
+
+        release.set()
+        await asyncio.gather(holder, queued)
+
+        assert admission.reject("c") is None
+        return retry_after
+
+    # one request queued and one running, each taking the default time
+    assert asyncio.run(run()) == pytest.approx(2 * DEFAULT_SERVICE_TIME)
+
+
+def test_clients_are_limited_to_their_rate():
+    admission = Admission(client_rate=1.0, client_burst=2)
+
+    assert admission.reject("a") is None
+    assert admission.reject("a") is None
+    assert admission.reject("a") == pytest.approx(1.0, abs=0.01)
+
+    # other clients have buckets of their own
+    assert admission.reject("b") is None
+
+    admission.forget("a")
+    assert admission.reject("a") is None
+
+
+def test_cancelled_request_leaves_the_queue():
+    async def run():
+        admission = Admission(budget=1)
+        order = []
+        release = asyncio.Event()
+
+        holder = asyncio.create_task(hold(admission, "a", 0, order, release))
+        queued = asyncio.create_task(hold(admission, "b", 0, order))
+        await asyncio.sleep(0)
+
+        assert len(admission.queue) == 1
+
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+
+        assert not admission.queue
+        assert "b" not in admission.in_flight
+
+        release.set()
+        await holder
+
+        assert admission.active == 0
+        return order
+
+    assert asyncio.run(run()) == [("a", 0)]
@@ -0,0 +1,63 @@
+from cache import LRUCache
+
+
+def test_least_recently_used_entries_are_evicted_past_the_budget():
+    cache = LRUCache(100)
+
+    cache.put("a", 1, 40)
+    cache.put("b", 2, 40)
+    cache.put("c", 3, 40)
+
+    assert cache.get("a") is None
+    assert cache.size == 80
+
+    # reading "b" makes "c" the oldest entry
+    assert cache.get("b") == 2
+    cache.put("d", 4, 40)
+
+    assert set(cache.entries) == {"b", "d"}
+    assert cache.size == 80
+
+
+def test_entries_larger_than_the_budget_are_not_cached():
+    cache = LRUCache(100)
+    cache.put("a", 1, 40)
+
+    cache.put("big", 2, 101)
+
+    assert cache.get("big") is None
+    assert cache.get("a") == 1
+
+
+def test_replacing_an_entry_counts_its_new_size():
+    cache = LRUCache(100)
+
+    cache.put("a", 1, 40)
+    cache.put("a", 2, 60)
+
+    assert cache.get("a") == 2
+    assert cache.size == 60
+
+
+def test_groups_are_dropped_together():
+    cache = LRUCache(100)
+
+    cache.put("a", 1, 10, group="peer1")
+    cache.put("b", 2, 10, group="peer1")
+    cache.put("c", 3, 10, group="peer2")
+
+    cache.discard_group("peer1")
+
+    assert set(cache.entries) == {"c"}
+    assert cache.size == 10
+    assert set(cache.groups) == {"peer2"}
+
+
+def test_hits_and_misses_are_counted():
+    cache = LRUCache(100)
+    cache.put("a", 1, 10)
+
+    cache.get("a")
+    cache.get("b")
+
+    assert (cache.hits, cache.misses) == (1, 1)
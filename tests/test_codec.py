@@ -0,0 +1,78 @@
+import pytest
+
+from codec import CODECS, JSON, MsgpackCodec
+
+codecs = list(CODECS.values())
+
+
+def items(count):
+    return [
+        {"filename": f"file{i}", "hostname": "host:1", "speed": "dsl"}
+        for i in range(count)
+    ]
+
+
+def fragments(codec, entries, run=7):
+    """
+    Encodes `entries` in runs of `run` items, like the server caches them per
+    peer, with an empty fragment for a peer without files.
+    """
+    encoded = [
+        codec.encode_items(entries[i : i + run]) for i in range(0, len(entries), run)
+    ]
+    return [b"", *encoded, b""]
+
+
+@pytest.mark.parametrize("codec", codecs, ids=lambda c: c.name)
+@pytest.mark.parametrize("count", [0, 1, 15, 16, 17, 65535, 65536])
+def test_join_items_round_trips(codec, count):
+    entries = items(count)
+
+    payload = codec.join_items(fragments(codec, entries, run=1000), count)
+
+    assert codec.decode(payload) == entries
+
+
+@pytest.mark.parametrize("codec", codecs, ids=lambda c: c.name)
+def test_join_items_of_single_items(codec):
+    entries = items(20)
+
+    payload = codec.join_items([codec.encode_items([e]) for e in entries], 20)
+
+    assert codec.decode(payload) == entries
+
+
+@pytest.mark.skipif("msgpack" not in CODECS, reason="msgpack is not installed")
+@pytest.mark.parametrize(
+    "count, header",
+    [
+        (0, b"\x90"),
+        (15, b"\x9f"),
+        (16, b"\xdc\x00\x10"),
+        (65535, b"\xdc\xff\xff"),
+        (65536, b"\xdd\x00\x01\x00\x00"),
+    ],
+)
+def test_msgpack_array_headers(count, header):
+    payload = MsgpackCodec().join_items([b"\xc0" * count], count)
+
+    assert payload.startswith(header)
+    assert payload == CODECS["msgpack"].encode([None] * count)
+
+
+@pytest.mark.parametrize("codec", codecs, ids=lambda c: c.name)
+@pytest.mark.parametrize("request_id", [0, 7, 2 ** 16, 2 ** 40, "tag"])
+@pytest.mark.parametrize("count", [0, 15, 16])
+def test_wrap_envelope_round_trips(codec, request_id, count):
+    entries = items(count)
+    payload = codec.join_items(fragments(codec, entries), count)
+
+    envelope = codec.wrap_envelope(request_id, payload)
+
+    assert codec.decode(envelope) == {"id": request_id, "body": entries}
+
+
+def test_json_envelope_of_plain_body():
+    envelope = JSON.wrap_envelope(3, JSON.encode({"success": True}))
+
+    assert JSON.decode(envelope) == {"id": 3, "body": {"success": True}}
@@ -0,0 +1,206 @@
+import asyncio
+
+import pytest
+
+from catalog import Peer
+from conftest import FrameWriter
+from server import Server
+
+PEERS = 3
+FILES_PER_PEER = 4
+FILES = PEERS * FILES_PER_PEER
+
+
+@pytest.fixture
+def server():
+    server = Server()
+
+    for p in range(PEERS):
+        peer = Peer(f"user{p}", f"host:{p}", ["dial-up", "dsl", "gigabit"][p], [])
+        server.catalog.add(peer)
+        server.set_files(
+            peer,
+            [
+                {"filename": f"file{i}.txt", "size": 100 * i, "mtime": 1.0}
+                for i in range(FILES_PER_PEER)
+            ],
+        )
+
+    return server
+
+
+@pytest.fixture
+def client(server):
+    client = Peer("me", "host:me", "dsl", [])
+    server.catalog.add(client)
+    return client
+
+
+def expected(server, sort, descending=False):
+    key = server.sort_key(sort)
+    entries = sorted(
+        (key(c, f), f.filename, c.hostname)
+        for c in server.catalog
+        for f in c.files.values()
+    )
+    names = [(filename, hostname) for _, filename, hostname in entries]
+    return names[::-1] if descending else names
+
+
+def walk(server, client, request):
+    pages = []
+    cursor = None
+
+    while True:
+        page, cursor = server.list_page(client, request, cursor)
+        pages.append([(f["filename"], f["hostname"]) for f in page])
+
+        if cursor is None:
+            return pages
+
+
+@pytest.mark.parametrize("sort", ["filename", "hostname", "speed", "fastest"])
+@pytest.mark.parametrize("descending", [False, True])
+@pytest.mark.parametrize("page_size", [1, 2, 3, 4, 5, 6, 7, 12, 13])
+def test_pages_cover_catalog_once(server, client, sort, descending, page_size):
+    request = {"sort": ("-" if descending else "") + sort, "page_size": page_size}
+
+    pages = walk(server, client, request)
+
+    assert [f for page in pages for f in page] == expected(server, sort, descending)
+
+    # a page size that divides the catalog ends on a full page, not an empty
+    # one after it
+    assert all(pages)
+    assert len(pages) == -(-FILES // page_size)
+
+
+def test_pages_skip_own_files(server, client):
+    server.set_files(client, [{"filename": "mine.txt", "size": 1, "mtime": 1.0}])
+
+    pages = walk(server, client, {"page_size": 5})
+
+    assert sum(len(page) for page in pages) == FILES
+    assert all(f[1] != "host:me" for page in pages for f in page)
+
+
+@pytest.mark.parametrize("sort", ["filename", "-filename", "speed", "-fastest"])
+@pytest.mark.parametrize("page_size", [3, 4, 5])
+def test_cursors_round_trip_through_requests(server, client, sort, page_size):
+    files = []
+    cursor = None
+
+    while True:
+        request = {"sort": sort, "page_size": page_size}
+        if cursor is not None:
+            request["cursor"] = cursor
+
+        writer = FrameWriter()
+        asyncio.run(server.send_list_pages(client, request, writer))
+        (frame,) = writer.frames()
+
+        files.extend((f["filename"], f["hostname"]) for f in frame["files"])
+        cursor = frame["cursor"]
+
+        if cursor is None:
+            break
+
+    assert files == expected(server, sort.lstrip("-"), sort.startswith("-"))
+
+
+def test_stream_sends_every_page(server, client):
+    writer = FrameWriter()
+    asyncio.run(
+        server.send_list_pages(client, {"page_size": 4, "stream": True}, writer)
+    )
+
+    frames = writer.frames()
+
+    assert [len(f["files"]) for f in frames] == [4, 4, 4]
+    assert [f["done"] for f in frames] == [False, False, True]
+    assert frames[-1]["cursor"] is None
+
+
+@pytest.mark.parametrize(
+    "request_fields, error",
+    [
+        ({"cursor": ["filename", 1, 2]}, "invalid cursor"),
+        ({"cursor": []}, "invalid cursor"),
+        ({"cursor": "filename"}, "invalid cursor"),
+        ({"cursor": ["filename", "file1.txt", "host:1"]}, "invalid cursor"),
+        ({"cursor": ["hostname", "file1.txt", "host:1", "user1"]}, "invalid cursor"),
+        ({"cursor": ["speed", "1", "file1.txt", "host:1", "user1"]}, "invalid cursor"),
+        ({"page_size": "10"}, "invalid page size"),
+        ({"page_size": 0}, "invalid page size"),
+        ({"page_size": True}, "invalid page size"),
+        ({"sort": 3}, "invalid sort"),
+        ({"sort": ["filename"]}, "invalid sort"),
+        ({"pattern": 5}, "invalid filter"),
+        ({"speed": [1]}, "invalid filter"),
+    ],
+)
+def test_invalid_requests_are_rejected(server, client, request_fields, error):
+    request = {"page_size": 4, **request_fields}
+
+    writer = FrameWriter()
+    asyncio.run(server.send_list_pages(client, request, writer))
+    (frame,) = writer.frames()
+
+    assert frame["error"].startswith(error)
+
+
+@pytest.mark.parametrize(
+    "request_fields, error",
+    [
+        ({"limit": -1}, "invalid limit"),
+        ({"limit": 0}, "invalid limit"),
+        ({"limit": "3"}, "invalid limit"),
+        ({"limit": True}, "invalid limit"),
+        ({"query": 5}, "invalid query"),
+        ({"query": None}, "invalid query"),
+        ({"mode": "regex"}, "invalid mode"),
+        ({"mode": ["glob"]}, "invalid mode"),
+    ],
+)
+def test_invalid_finds_are_rejected(server, client, request_fields, error):
+    request = {"query": "file", **request_fields}
+
+    writer = FrameWriter()
+    asyncio.run(server.find_files(client, request, writer))
+    (frame,) = writer.frames()
+
+    assert frame["error"].startswith(error)
+
+
+def test_find_limit_is_capped(server, client):
+    writer = FrameWriter()
+    asyncio.run(server.find_files(client, {"query": "file", "limit": 5}, writer))
+    (frame,) = writer.frames()
+
+    assert len(frame["files"]) == 5
+
+
+def test_measurements_only_resort_fastest(server, client):
+    peer = server.catalog.get("user0")
+    by_name = server.list_run(peer, "filename")
+    fastest = server.list_run(peer, "fastest")
+
+    server.observe("host:0", lambda stats: stats.observe_rtt(30.0))
+
+    assert server.list_run(peer, "filename")[0] is by_name[0]
+    assert server.list_run(peer, "fastest")[0] is not fastest[0]
+
+
+def test_changes_only_resort_that_peer(server, client):
+    changed, unchanged = server.catalog.get("user0"), server.catalog.get("user1")
+    before = server.list_run(unchanged, "filename")
+
+    walk(server, client, {"page_size": 5})
+    server.index_file(changed, {"filename": "added.txt", "size": 1, "mtime": 1.0})
+    server.touch(changed)
+
+    assert server.list_run(unchanged, "filename")[0] is before[0]
+    assert server.list_run(changed, "filename")[0][0][0] == "added.txt"
+
+    pages = walk(server, client, {"page_size": 5})
+    assert [f for page in pages for f in page] == expected(server, "filename")
@@ -0,0 +1,111 @@
+from peerstats import (
+    BREAKER_COOLDOWN,
+    BREAKER_THRESHOLD,
+    DEFAULT_RATE,
+    OPEN_BREAKER_PENALTY,
+    CircuitBreaker,
+    PeerStats,
+)
+
+
+def tripped():
+    breaker = CircuitBreaker()
+    for _ in range(BREAKER_THRESHOLD):
+        breaker.failure()
+    return breaker
+
+
+def cool_down(breaker):
+    # pretend the cooldown passed, without sleeping through it
+    breaker.opened_at -= breaker.cooldown
+    if breaker.trial is not None:
+        breaker.trial -= breaker.cooldown
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker()
+
+    for _ in range(BREAKER_THRESHOLD - 1):
+        breaker.failure()
+    assert not breaker.open
+    assert breaker.allow()
+
+    breaker.failure()
+    assert breaker.open
+    assert not breaker.allow()
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker()
+
+    for _ in range(BREAKER_THRESHOLD - 1):
+        breaker.failure()
+    breaker.success()
+    breaker.failure()
+
+    assert not breaker.open
+
+
+def test_half_open_breaker_lets_one_trial_through():
+    breaker = tripped()
+    cool_down(breaker)
+
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_successful_trial_closes_the_breaker():
+    breaker = tripped()
+    cool_down(breaker)
+    assert breaker.allow()
+
+    breaker.success()
+
+    assert not breaker.open
+    assert breaker.allow()
+    assert breaker.cooldown == BREAKER_COOLDOWN
+
+
+def test_failed_trial_reopens_with_a_longer_cooldown():
+    breaker = tripped()
+    cool_down(breaker)
+    assert breaker.allow()
+
+    breaker.failure()
+
+    assert breaker.open
+    assert breaker.cooldown == 2 * BREAKER_COOLDOWN
+    assert not breaker.allow()
+
+    cool_down(breaker)
+    assert breaker.allow()
+
+
+def test_lost_trial_is_given_up_on_after_the_cooldown():
+    breaker = tripped()
+    cool_down(breaker)
+    assert breaker.allow()
+
+    # the trial never reported back
+    cool_down(breaker)
+    assert breaker.allow()
+
+
+def test_reported_transfers_never_trip_the_breaker():
+    stats = PeerStats()
+
+    for _ in range(BREAKER_THRESHOLD * 2):
+        stats.observe_transfer(0, 0.0, False)
+
+    assert not stats.breaker.open
+    assert stats.reliability < 0.5
+
+
+def test_open_breaker_ranks_the_peer_last():
+    stats = PeerStats()
+    before = stats.expected_time(1000, DEFAULT_RATE)
+
+    for _ in range(BREAKER_THRESHOLD):
+        stats.breaker.failure()
+
+    assert stats.expected_time(1000, DEFAULT_RATE) == before * OPEN_BREAKER_PENALTY
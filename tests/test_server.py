@@ -0,0 +1,170 @@
+import asyncio
+import time
+
+import pytest
+
+from catalog import Peer
+from conftest import FrameWriter
+from server import Server
+from trigrams import encode_trigrams, trigrams
+
+FILES = {
+    "user0": [
+        {"filename": "holiday-photo.png", "size": 300, "mtime": 1.0},
+        {"filename": "notes.txt", "size": 10, "mtime": 1.0, "description": "Lab"},
+    ],
+    "user1": [
+        {"filename": "hello_world.py", "size": 20, "mtime": 1.0},
+        {"filename": "report-2019.pdf", "size": 500, "mtime": 1.0},
+    ],
+}
+
+
+@pytest.fixture
+def server():
+    server = Server()
+
+    for p, username in enumerate(FILES):
+        peer = Peer(username, f"host:{p}", "dsl", [])
+        server.catalog.add(peer)
+        server.set_files(peer, FILES[username])
+
+    return server
+
+
+@pytest.fixture
+def client(server):
+    client = Peer("me", "host:me", "dsl", [])
+    server.catalog.add(client)
+    server.set_files(client, [{"filename": "hello.txt", "size": 1, "mtime": 1.0}])
+    return client
+
+
+def find(server, client, **request):
+    writer = FrameWriter()
+    asyncio.run(server.find_files(client, request, writer))
+    (frame,) = writer.frames()
+    return sorted(f["filename"] for f in frame["files"])
+
+
+@pytest.mark.parametrize(
+    "request_fields, found",
+    [
+        ({"query": "PHOTO"}, ["holiday-photo.png"]),
+        ({"query": "lab"}, ["notes.txt"]),
+        ({"query": "ot"}, ["holiday-photo.png", "notes.txt"]),
+        ({"query": "he", "mode": "prefix"}, ["hello_world.py"]),
+        ({"query": "ello", "mode": "prefix"}, []),
+        ({"query": "*-20??.pdf", "mode": "glob"}, ["report-2019.pdf"]),
+        ({"query": "*.p?", "mode": "glob"}, ["hello_world.py"]),
+        ({"query": "holday photo", "mode": "fuzzy"}, ["holiday-photo.png"]),
+    ],
+)
+def test_find_matches(server, client, request_fields, found):
+    assert find(server, client, **request_fields) == found
+
+
+def test_find_skips_own_files(server, client):
+    assert find(server, client, query="hello") == ["hello_world.py"]
+
+
+def test_find_sees_changed_files(server, client):
+    peer = server.catalog.get("user1")
+
+    server.unindex_file(peer, "hello_world.py")
+    server.index_file(peer, {"filename": "goodbye.py", "size": 1, "mtime": 1.0})
+
+    assert find(server, client, query="hello") == []
+    assert find(server, client, query="goodbye") == ["goodbye.py"]
+
+
+def test_files_without_trigrams_are_left_to_their_peer(server):
+    peer = server.catalog.get("user0")
+    indexed = {
+        "filename": "indexed.txt",
+        "size": 1,
+        "mtime": 1.0,
+        "trigrams": encode_trigrams(trigrams(b"some text"), False),
+    }
+
+    server.index_file(peer, indexed)
+
+    assert ("user0", "indexed.txt") not in server.unindexed
+    assert ("user0", "notes.txt") in server.unindexed
+
+    server.unindex_file(peer, "notes.txt")
+    assert ("user0", "notes.txt") not in server.unindexed
+
+    server.forget_files(peer)
+    assert not any(username == "user0" for username, _ in server.unindexed)
+
+
+def connect(server, digest):
+    request = {
+        "username": "user0",
+        "hostname": "host:0",
+        "speed": "dsl",
+        "digest": digest,
+    }
+
+    writer = FrameWriter()
+    client = asyncio.run(server.handle_request("CONNECT", request, None, None, writer))
+    (frame,) = writer.frames()
+    return client, frame
+
+
+def leave(server, peer):
+    async def run():
+        server.catalog.remove(peer)
+        await server.retain(peer)
+
+    asyncio.run(run())
+
+
+def test_reconnect_with_same_digest_restores_catalog(server):
+    peer = server.catalog.get("user0")
+    digest = server.digest(peer)
+    leave(server, peer)
+
+    client, frame = connect(server, digest)
+
+    assert frame == {"success": "connection successful", "restored": True}
+    assert client.files is peer.files
+    assert server.catalog.get("user0") is client
+    assert "user0" not in server.departed
+
+
+def test_reconnect_with_other_digest_requires_files(server):
+    peer = server.catalog.get("user0")
+    leave(server, peer)
+
+    client, frame = connect(server, "something else")
+
+    assert client is None
+    assert frame == {"files_required": True}
+    assert "user0" not in server.departed
+
+
+def test_stale_peers_are_evicted_and_retained(server):
+    server.stale_after = 0.04
+
+    stale = server.catalog.get("user0")
+    stale.last_seen = time.monotonic() - 1
+    fresh = server.catalog.get("user1")
+    fresh.last_seen = time.monotonic() + 60
+
+    writer = FrameWriter()
+    server.connections[stale] = writer
+
+    async def run():
+        evicting = asyncio.create_task(server.evict_stale_forever())
+        await asyncio.sleep(0.05)
+        evicting.cancel()
+
+    asyncio.run(run())
+
+    assert server.catalog.get("user0") is None
+    assert server.catalog.get("user1") is fresh
+    assert server.departed["user0"][0] is stale
+    assert writer.closed
+    assert stale not in server.connections
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from ftp.shaping import TokenBucket, UploadSlots
+
+
+def test_bucket_without_rate_never_waits():
+    bucket = TokenBucket()
+
+    assert bucket.take(10 ** 9) == 0
+
+
+def test_bucket_takes_up_to_its_burst():
+    bucket = TokenBucket(rate=100.0, burst=50.0)
+
+    assert bucket.take(50) == 0
+
+    # the missing tokens come in at `rate`
+    assert bucket.take(10) == pytest.approx(0.1, abs=0.01)
+
+
+def test_bucket_refills_up_to_its_burst():
+    bucket = TokenBucket(rate=100.0, burst=50.0)
+    bucket.take(50)
+
+    bucket.updated -= 100
+    bucket.refill()
+
+    assert bucket.tokens == 50.0
+
+
+def test_bucket_consumers_go_into_debt():
+    async def run():
+        bucket = TokenBucket(rate=1000.0, burst=0.0)
+        started = asyncio.get_running_loop().time()
+        await bucket.consume(50)
+        return asyncio.get_running_loop().time() - started, bucket.tokens
+
+    elapsed, tokens = asyncio.run(run())
+
+    assert elapsed >= 0.04
+    assert tokens == pytest.approx(-50, abs=5)
+
+
+def test_upload_slots_queue_in_order_and_report_positions():
+    async def run():
+        slots = UploadSlots(1)
+        positions = {"b": [], "c": []}
+        order = []
+
+        async def upload(name):
+            async def notify(position):
+                positions[name].append(position)
+
+            await slots.acquire(notify)
+            order.append(name)
+
+        await slots.acquire()
+
+        queued = [asyncio.create_task(upload(name)) for name in ("b", "c")]
+        await asyncio.sleep(0.01)
+
+        slots.release()
+        await queued[0]
+        await asyncio.sleep(0.01)
+
+        slots.release()
+        await queued[1]
+
+        assert slots.active == 1
+        return order, positions
+
+    order, positions = asyncio.run(run())
+
+    assert order == ["b", "c"]
+    assert positions == {"b": [1], "c": [2, 1]}
+
+
+def test_cancelled_upload_leaves_the_queue():
+    async def run():
+        slots = UploadSlots(1)
+        await slots.acquire()
+
+        queued = asyncio.create_task(slots.acquire())
+        await asyncio.sleep(0.01)
+        assert len(slots.waiting) == 1
+
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+
+        assert not slots.waiting
+
+        slots.release()
+        return slots.active
+
+    assert asyncio.run(run()) == 0
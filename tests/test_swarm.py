@@ -0,0 +1,65 @@
+import hashlib
+import os
+
+import pytest
+
+import common
+from ftp.swarm import SwarmDownload
+
+PIECE_SIZE = 4
+DATA = b"abcdefghijklmn"
+
+
+@pytest.fixture
+def swarm():
+    swarm = SwarmDownload("file.bin", [])
+    swarm.piece_size = PIECE_SIZE
+    swarm.size = len(DATA)
+    swarm.pieces = [
+        hashlib.sha256(DATA[i : i + PIECE_SIZE]).hexdigest()
+        for i in range(0, len(DATA), PIECE_SIZE)
+    ]
+    return swarm
+
+
+def test_last_piece_is_shorter(swarm):
+    assert [swarm.piece_length(i) for i in range(len(swarm.pieces))] == [4, 4, 4, 2]
+
+
+def test_existing_partial_keeps_only_verified_pieces(swarm, tmp_path):
+    partial = tmp_path / "partial"
+    partial.write_bytes(DATA[:4] + b"XXXX" + DATA[8:10])
+
+    with open(partial, "r+b") as outfile:
+        done = swarm.check_existing(outfile)
+
+    assert done == {0}
+    assert os.path.getsize(partial) == len(DATA)
+
+
+def test_pieces_are_written_only_if_they_verify(swarm, tmp_path):
+    partial = tmp_path / "partial"
+
+    with open(partial, "w+b") as outfile:
+        swarm.check_existing(outfile)
+
+        assert not swarm.write_piece(outfile, 1, b"XXXX")
+        assert swarm.write_piece(outfile, 3, DATA[12:])
+        assert swarm.write_piece(outfile, 1, DATA[4:8])
+
+        assert swarm.check_existing(outfile) == {1, 3}
+
+    assert partial.read_bytes() == b"\0" * 4 + DATA[4:8] + b"\0" * 4 + DATA[12:]
+
+
+def test_swarm_partial_is_not_taken_for_a_download(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    open(common.swarm_path("file.bin", len(DATA)), "wb").close()
+
+    assert common.find_download("file.bin") is None
+
+    path = common.download_path("file.bin", len(DATA), 7)
+    open(path, "wb").close()
+
+    assert common.find_download("file.bin") == (path, len(DATA), 7)